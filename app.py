@@ -2,12 +2,35 @@ import streamlit as st
 import pandas as pd
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
-from datetime import datetime
+from google.api_core import exceptions as gexc
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
 import base64
+import csv
+import hashlib
+import html
+import io
+import os
+import socket
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+import urllib.request
 import uuid
 import json
 import streamlit.components.v1 as components
+from PIL import Image
+import qrcode
+import qrcode.image.svg
+
+try:  # Parquet es opcional para la exportación
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # ============================================================
 # KIN HOUSE POS PRO — v3.0
@@ -27,6 +50,18 @@ def now_iso() -> str:
     return now_cdmx().isoformat()
 
 
+def time_buckets(moment: datetime = None) -> dict:
+    """Marca de tiempo ISO más cubetas numéricas en hora de CDMX (época, día, hora, día ISO de la semana)."""
+    moment = (moment or now_cdmx()).astimezone(CDMX_TZ)
+    return {
+        "fecha": moment.isoformat(),
+        "ts": int(moment.timestamp()),
+        "dia": moment.strftime("%Y-%m-%d"),
+        "hora": moment.hour,
+        "dow": moment.isoweekday(),
+    }
+
+
 def money(n) -> str:
     try:
         return f"${float(n):,.0f}"
@@ -42,6 +77,12 @@ def init_state():
         "cid": None,
         "enom": None,
         "dialog_payload": None,
+        "order_cache": {},
+        "pending_sale": None,
+        "last_ticket": None,
+        "report_pages": None,
+        "export_file": None,
+        "catalog_import": None,
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -228,6 +269,26 @@ h2, h3 {
     box-shadow: 0 2px 8px var(--shadow);
 }
 
+/* Selector de categoría del menú */
+.stRadio div[role="radiogroup"] {
+    gap: 6px;
+    background: var(--sand);
+    padding: 6px;
+    border-radius: 12px;
+}
+.stRadio div[role="radiogroup"] label {
+    padding: 6px 12px;
+    border-radius: 8px;
+    font-weight: 500;
+    font-size: 13px;
+    color: var(--bark);
+}
+.stRadio div[role="radiogroup"] label:has(input:checked) {
+    background: var(--white);
+    color: var(--sienna);
+    box-shadow: 0 2px 8px var(--shadow);
+}
+
 /* Inputs */
 .stTextInput > div > div > input,
 .stNumberInput > div > div > input,
@@ -271,6 +332,7 @@ hr {
 """, unsafe_allow_html=True)
 
 
+@st.cache_resource
 def init_firebase():
     try:
         if not firebase_admin._apps:
@@ -291,6 +353,278 @@ db = init_firebase()
 bucket = storage.bucket(name=st.secrets["firebase_credentials"]["firebase_storage_bucket"])
 
 
+# ---------------------------
+# LISTENERS EN TIEMPO REAL
+# ---------------------------
+# Un listener on_snapshot por consulta, compartido por todas las sesiones del
+# proceso (st.cache_resource). Las vistas leen de memoria y solo vuelven a
+# consultar Firestore si el listener todavía no responde o se cayó. Solo se
+# espera el primer snapshot al crear el listener; después, mientras no
+# llegue, las lecturas regresan None al momento (sin red no se acumulan
+# esperas en cada ejecución).
+LIVE_QUERY_TIMEOUT = 3  # segundos de espera por el primer snapshot, una vez
+
+
+class LiveQuery:
+    """Resultado de una consulta (o documento) mantenido al día vía on_snapshot."""
+
+    def __init__(self, target):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # (generación, {doc_id: data}, {doc_id: update_time}) del mismo
+        # snapshot; se reemplaza completo para que nunca se lean mezclados.
+        self._snapshot = (0, {}, {})
+        self._watch = target.on_snapshot(self._on_snapshot)
+        self._ready.wait(LIVE_QUERY_TIMEOUT)
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        docs = {d.id: d.to_dict() or {} for d in snapshots if d.exists}
+        times = {d.id: d.update_time for d in snapshots if d.exists}
+        with self._lock:
+            self._snapshot = (self._snapshot[0] + 1, docs, times)
+        self._ready.set()
+
+    def alive(self) -> bool:
+        return bool(getattr(self._watch, "is_active", True))
+
+    def close(self):
+        try:
+            self._watch.unsubscribe()
+        except Exception:
+            pass
+
+    def snapshot(self):
+        """Devuelve (generación, docs, update_times) de un mismo snapshot, o None si aún no hay."""
+        if not self._ready.is_set():
+            return None
+        with self._lock:
+            return self._snapshot
+
+
+def live_snapshot(factory, *args):
+    try:
+        live = factory(*args)
+    except Exception:
+        return None
+    if not live.alive():
+        live.close()
+        factory.clear()
+        return None
+    return live.snapshot()
+
+
+def live_docs(factory, *args):
+    snap = live_snapshot(factory, *args)
+    return snap[1] if snap is not None else None
+
+
+@st.cache_resource
+def _open_orders_live() -> LiveQuery:
+    return LiveQuery(db.collection("comandas").where("estado", "==", "ABIERTA"))
+
+
+@st.cache_resource
+def _open_cashbox_live() -> LiveQuery:
+    return LiveQuery(db.collection("cajas").where("estado", "==", "ABIERTA").limit(1))
+
+
+@st.cache_resource
+def _branding_live() -> LiveQuery:
+    return LiveQuery(db.collection("config").document("branding"))
+
+
+# ---------------------------
+# COLA LOCAL DE ESCRITURAS (OFFLINE)
+# ---------------------------
+# Comandas, renglones, cobros y egresos se guardan primero en un diario SQLite
+# local y la pantalla sigue sin esperar a la red. Un hilo de fondo los envía a
+# Firestore en orden, con reintentos; cada operación es idempotente, así que
+# reenviarla tras un corte no duplica nada.
+LOCAL_DB_PATH = os.environ.get("KIN_LOCAL_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "kin_local.sqlite3"))
+SYNC_MAX_BACKOFF = 60  # segundos
+SYNC_MAX_ATTEMPTS = 8  # fallos inesperados antes de apartar la operación
+# Sin red la operación de la cabeza espera sin límite: las de atrás tampoco
+# pasarían. Cualquier otro error cuenta intentos y, al agotarlos, la operación
+# queda "fallida" para que no detenga la cola.
+SYNC_TRANSIENT_ERRORS = (
+    gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.RetryError, gexc.Aborted,
+    gexc.TooManyRequests, gexc.InternalServerError, ConnectionError, TimeoutError,
+)
+
+
+class SyncConflict(Exception):
+    """La operación ya no aplica en Firestore (p. ej. la comanda se cerró en otra terminal)."""
+
+
+class SyncJournal:
+    """Diario durable de operaciones pendientes de enviar a Firestore."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pendientes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                op_id TEXT UNIQUE NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )
+        """)
+
+    def enqueue(self, op: str, payload: dict) -> str:
+        op_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO pendientes (op_id, op, payload, created_at) VALUES (?, ?, ?, ?)",
+                (op_id, op, json.dumps(payload, ensure_ascii=False), now_iso()),
+            )
+        return op_id
+
+    def next_pending(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT op_id, op, payload FROM pendientes WHERE estado = 'pendiente' ORDER BY seq LIMIT 1"
+            ).fetchone()
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+    def pending(self, *ops: str) -> list:
+        marks = ",".join("?" * len(ops))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT op, payload FROM pendientes WHERE estado = 'pendiente' AND op IN ({marks}) ORDER BY seq",
+                ops,
+            ).fetchall()
+        return [(op, json.loads(payload)) for op, payload in rows]
+
+    def pending_for(self, doc_id: str) -> list:
+        """Operaciones pendientes de una comanda (abrir, renglones, cobro), en orden."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT op, payload FROM pendientes WHERE estado = 'pendiente'"
+                " AND (json_extract(payload, '$.cid') = ? OR json_extract(payload, '$.id') = ?) ORDER BY seq",
+                (doc_id, doc_id),
+            ).fetchall()
+        return [(op, json.loads(payload)) for op, payload in rows]
+
+    def mark_done(self, op_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM pendientes WHERE op_id = ?", (op_id,))
+
+    def mark_retry(self, op_id: str, error: str) -> int:
+        with self._lock:
+            self._conn.execute("UPDATE pendientes SET intentos = intentos + 1, error = ? WHERE op_id = ?", (error, op_id))
+            row = self._conn.execute("SELECT intentos FROM pendientes WHERE op_id = ?", (op_id,)).fetchone()
+        return row[0] if row else 0
+
+    def mark_conflict(self, op_id: str, error: str, estado: str = "conflicto"):
+        with self._lock:
+            self._conn.execute("UPDATE pendientes SET estado = ?, error = ? WHERE op_id = ?", (estado, error, op_id))
+
+    def conflicts(self) -> list:
+        """Operaciones apartadas (conflicto o fallida) para revisión manual."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT op_id, op, estado, created_at, intentos, error, payload FROM pendientes"
+                " WHERE estado IN ('conflicto', 'fallida') ORDER BY seq"
+            ).fetchall()
+        result = []
+        for op_id, op, estado, created_at, intentos, error, payload in rows:
+            sale = json.loads(payload).get("sale") or {}
+            result.append({
+                "op_id": op_id, "op": op, "estado": estado, "created_at": created_at,
+                "intentos": intentos, "error": error, "folio": sale.get("folio"), "total": sale.get("total"),
+            })
+        return result
+
+    def requeue(self, op_ids: list):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pendientes SET estado = 'pendiente', intentos = 0 WHERE op_id = ?",
+                [(op_id,) for op_id in op_ids],
+            )
+
+    def discard(self, op_ids: list) -> int:
+        # Un cobro ya recibió el dinero: nunca se descarta, solo se reintenta.
+        with self._lock:
+            cur = self._conn.executemany(
+                "DELETE FROM pendientes WHERE op_id = ? AND op != 'cobrar'", [(op_id,) for op_id in op_ids]
+            )
+        return cur.rowcount
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT estado, COUNT(*) FROM pendientes GROUP BY estado").fetchall()
+        return dict(rows)
+
+
+class SyncWorker(threading.Thread):
+    """Vacía el diario hacia Firestore en orden; espera con backoff si no hay red.
+
+    En cada vuelta corre además las tareas de fondo (p. ej. reservar bloques
+    de folios); si una falla se vuelve a intentar pasado SYNC_MAX_BACKOFF.
+    """
+
+    def __init__(self, journal: SyncJournal, appliers: dict, tasks: list = ()):
+        super().__init__(name="kin-sync", daemon=True)
+        self.journal = journal
+        self.appliers = appliers
+        self.tasks = list(tasks)
+        self._tasks_after = 0.0
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def _sleep(self, seconds: float):
+        self._wake.wait(seconds)
+        self._wake.clear()
+
+    def _run_tasks(self):
+        if time.monotonic() < self._tasks_after:
+            return
+        for task in self.tasks:
+            try:
+                task()
+            except Exception:
+                self._tasks_after = time.monotonic() + SYNC_MAX_BACKOFF
+
+    def run(self):
+        backoff = 1
+        while True:
+            self._run_tasks()
+            entry = self.journal.next_pending()
+            if entry is None:
+                self._sleep(30)
+                continue
+            op_id, op, payload = entry
+            try:
+                self.appliers[op](op_id, payload)
+            except (SyncConflict, gexc.InvalidArgument, gexc.NotFound) as e:
+                self.journal.mark_conflict(op_id, str(e))
+            except SYNC_TRANSIENT_ERRORS as e:
+                self.journal.mark_retry(op_id, str(e))
+                self._sleep(backoff)
+                backoff = min(backoff * 2, SYNC_MAX_BACKOFF)
+            except Exception as e:
+                if self.journal.mark_retry(op_id, repr(e)) >= SYNC_MAX_ATTEMPTS:
+                    self.journal.mark_conflict(op_id, repr(e), estado="fallida")
+                self._sleep(backoff)
+                backoff = min(backoff * 2, SYNC_MAX_BACKOFF)
+            else:
+                self.journal.mark_done(op_id)
+                backoff = 1
+
+
+@st.cache_resource
+def sync_journal() -> SyncJournal:
+    return SyncJournal(LOCAL_DB_PATH)
+
+
 # ---------------------------
 # DATA HELPERS
 # ---------------------------
@@ -304,19 +638,76 @@ def upload_logo_to_storage(file_bytes: bytes, filename: str) -> str:
     return blob.public_url
 
 
+# config/branding se lee del listener (memoria del proceso); sin listener, de
+# una lectura cacheada que save_brand() invalida. Al subir el logo se guardan
+# ya reducidos, como data URI, los tamaños que usa la app ("logos"), así
+# mostrarlo nunca depende de la red. Logos anteriores sin esa copia se
+# descargan una vez y sus tamaños se guardan en config/branding.
+DEFAULT_BRAND = {"logo_url": "", "logos": {}, "nombre": "KIN House", "slogan": "Mismo sabor, mismo lugar"}
+SIDEBAR_LOGO_PX = 160  # se muestra a 80 px; el doble para pantallas de alta densidad
+TICKET_LOGO_PX = 164
+
+
+@st.cache_data(ttl=300)
+def _read_brand() -> dict:
+    doc = db.collection("config").document("branding").get()
+    return (doc.to_dict() or {}) if doc.exists else {}
+
+
 def get_brand() -> dict:
     try:
-        doc = db.collection("config").document("branding").get()
-        if doc.exists:
-            data = doc.to_dict() or {}
-            return {
-                "logo_url": data.get("logo_url", ""),
-                "nombre": data.get("nombre", "KIN House"),
-                "slogan": data.get("slogan", "Mismo sabor, mismo lugar"),
-            }
+        docs = live_docs(_branding_live)
+        data = docs.get("branding", {}) if docs is not None else _read_brand()
+    except Exception:
+        data = {}
+    return {k: data.get(k, default) for k, default in DEFAULT_BRAND.items()}
+
+
+def save_brand(fields: dict):
+    db.collection("config").document("branding").set(fields, merge=True)
+    _read_brand.clear()
+
+
+def resize_logo(raw: bytes, size: int) -> str:
+    img = Image.open(io.BytesIO(raw)).convert("RGBA")
+    img.thumbnail((size, size))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+def brand_logos(raw: bytes) -> dict:
+    return {str(size): resize_logo(raw, size) for size in (SIDEBAR_LOGO_PX, TICKET_LOGO_PX)}
+
+
+@st.cache_data(ttl=300, max_entries=4, show_spinner=False)
+def _download_logos(url: str) -> dict:
+    # Una descarga fallida devuelve {} y queda en caché solo por el ttl: sin
+    # red no se espera en cada ejecución, pero el logo vuelve a intentarse.
+    try:
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            logos = brand_logos(resp.read())
+    except (OSError, ValueError):
+        return {}
+    try:
+        # Solo si el logo no cambió mientras tanto (precondición sobre la
+        # versión leída); si falla, se guarda en la siguiente descarga.
+        ref = db.collection("config").document("branding")
+        snap = ref.get()
+        if (snap.to_dict() or {}).get("logo_url") == url:
+            ref.update({"logos": logos}, option=db.write_option(last_update_time=snap.update_time))
+            _read_brand.clear()
     except Exception:
         pass
-    return {"logo_url": "", "nombre": "KIN House", "slogan": "Mismo sabor, mismo lugar"}
+    return logos
+
+
+def logo_src(brand: dict, size: int) -> str:
+    """Logo reducido como data URI; sin copia guardada ni descarga, la URL original."""
+    if not brand.get("logo_url"):
+        return ""
+    logos = brand.get("logos") or _download_logos(brand["logo_url"])
+    return logos.get(str(size)) or brand["logo_url"]
 
 
 brand = get_brand()
@@ -327,6 +718,9 @@ def get_admin_pin() -> str:
 
 
 def get_open_cashbox():
+    docs = live_docs(_open_cashbox_live)
+    if docs is not None:
+        return next((dict(row, id=doc_id) for doc_id, row in docs.items()), None)
     try:
         q = db.collection("cajas").where("estado", "==", "ABIERTA").limit(1).stream()
         return next((d.to_dict() | {"id": d.id} for d in q), None)
@@ -335,61 +729,1409 @@ def get_open_cashbox():
         return None
 
 
+@st.cache_resource
+def _open_orders_index() -> dict:
+    # Índice espacio -> [comandas abiertas por created_at], recalculado solo
+    # cuando el listener entrega un snapshot nuevo.
+    return {"generation": None, "index": {}}
+
+
+def _index_open_orders(docs: dict) -> dict:
+    index = {}
+    for doc_id, row in docs.items():
+        if row.get("espacio"):
+            index.setdefault(row["espacio"], []).append((row.get("created_at", ""), doc_id))
+    return {space: [doc_id for _, doc_id in sorted(rows)] for space, rows in index.items()}
+
+
 def get_open_orders_by_space() -> dict:
-    data = {}
-    try:
-        for d in db.collection("comandas").where("estado", "==", "ABIERTA").stream():
-            row = d.to_dict() or {}
-            espacio = row.get("espacio")
-            if espacio:
-                data[espacio] = d.id
-    except Exception as e:
-        st.error(f"No fue posible cargar comandas: {e}")
-    return data
+    """{espacio: [ids de comandas abiertas, de la más antigua a la más nueva]}."""
+    snap = live_snapshot(_open_orders_live)
+    if snap is not None:
+        generation, docs, _ = snap
+        cache = _open_orders_index()
+        if cache["generation"] != generation:
+            cache["index"], cache["generation"] = _index_open_orders(docs), generation
+        index = cache["index"]
+    else:
+        try:
+            index = _index_open_orders({
+                d.id: d.to_dict() or {} for d in db.collection("comandas").where("estado", "==", "ABIERTA").stream()
+            })
+        except Exception as e:
+            st.error(f"No fue posible cargar comandas: {e}")
+            index = {}
+
+    # Aperturas, cobros y cancelaciones que siguen en la cola local todavía no están en Firestore.
+    data = {space: list(ids) for space, ids in index.items()}
+    for op, payload in sync_journal().pending("abrir_comanda", "cobrar", "cancelar_comanda"):
+        if op == "abrir_comanda":
+            ids = data.setdefault(payload["data"]["espacio"], [])
+            if payload["id"] not in ids:
+                ids.append(payload["id"])
+        else:
+            data = {k: [x for x in v if x != payload["cid"]] for k, v in data.items()}
+    return {k: v for k, v in data.items() if v}
+
+
+# ---------------------------
+# ESPACIOS (MESAS Y CANALES)
+# ---------------------------
+# espacios/{id} = {nombre, zona, orden, activo, cola}. Las comandas guardan el
+# nombre del espacio. La lista se sirve del listener y se siembra con el
+# acomodo original la primera vez. Los espacios con cola (barra, para llevar)
+# abren un pedido nuevo con número del día en cada toque.
+DEFAULT_SPACES = [
+    ("Mesa 1", "Salón"), ("Mesa 2", "Salón"), ("Mesa 3", "Salón"), ("Mesa 4", "Salón"),
+    ("Sillón 1", "Salón"), ("Sillón 2", "Salón"), ("Barra", "Barra"), ("Llevar", "Para llevar"),
+]
+QUEUE_SPACES = {"Barra", "Llevar"}  # admiten varios pedidos abiertos con número
+SPACES_PER_PAGE = 16
+
+
+@st.cache_resource
+def _spaces_live() -> LiveQuery:
+    return LiveQuery(db.collection("espacios"))
+
+
+def _default_space_docs() -> dict:
+    return {
+        hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]: {
+            "nombre": name, "zona": zone, "orden": i, "activo": True, "cola": name in QUEUE_SPACES,
+        }
+        for i, (name, zone) in enumerate(DEFAULT_SPACES)
+    }
+
+
+def get_spaces(include_inactive: bool = False) -> list:
+    docs = live_docs(_spaces_live)
+    if docs is None:
+        try:
+            docs = {d.id: d.to_dict() or {} for d in db.collection("espacios").stream()}
+        except Exception:
+            docs = _default_space_docs()
+    if not docs:
+        docs = _default_space_docs()
+        commit_writes(("set", db.collection("espacios").document(sid), row) for sid, row in docs.items())
+    rows = [dict({"cola": row.get("nombre") in QUEUE_SPACES}, **row, id=sid)
+            for sid, row in docs.items() if include_inactive or row.get("activo", True)]
+    return sorted(rows, key=lambda r: (int(r.get("orden", 0) or 0), r.get("nombre", "")))
+
+
+def validate_space_changes(rows: list) -> list:
+    """Errores de renombrar o borrar espacios que tienen comandas abiertas.
+
+    Las comandas guardan el nombre del espacio: con otro nombre (o sin el
+    espacio) quedarían fuera de la cuadrícula y de la cola.
+    """
+    busy = get_open_orders_by_space()
+    kept = {row.get("id"): str(row["nombre"]).strip() for row in rows if row.get("id")}
+    errors = []
+    for space in get_spaces(include_inactive=True):
+        if space.get("nombre") not in busy:
+            continue
+        if space["id"] not in kept:
+            errors.append(f"«{space['nombre']}» tiene comandas abiertas; ciérralas antes de borrarlo.")
+        elif kept[space["id"]] != space["nombre"]:
+            errors.append(f"«{space['nombre']}» tiene comandas abiertas; ciérralas antes de renombrarlo.")
+    return errors
+
+
+def save_spaces(rows: list) -> int:
+    """Reemplaza la lista de espacios; los que ya no vienen se borran."""
+    current = {s["id"] for s in get_spaces(include_inactive=True)}
+    writes, kept = [], set()
+    for i, row in enumerate(rows):
+        sid = row.get("id") or db.collection("espacios").document().id
+        kept.add(sid)
+        writes.append(("set", db.collection("espacios").document(sid), {
+            "nombre": str(row["nombre"]).strip(),
+            "zona": str(row.get("zona") or "General").strip(),
+            "orden": int(row.get("orden") or i),
+            "activo": row.get("activo") is not False,
+            "cola": bool(row.get("cola")),
+        }))
+    writes += [("delete", db.collection("espacios").document(sid), None) for sid in current - kept]
+    return commit_writes(writes)
+
+
+def get_order_queue(space_names: list) -> list:
+    """Pedidos abiertos de los espacios con cola, del más antiguo al más nuevo.
+
+    Sale del listener de comandas abiertas; sin él, de una consulta indexada
+    (espacio, estado, created_at).
+    """
+    names = set(space_names)
+    docs = live_docs(_open_orders_live)
+    if docs is None:
+        docs = {}
+        try:
+            # "in" admite hasta 30 valores: una consulta por grupo
+            ordered = sorted(names)
+            for i in range(0, len(ordered), 30):
+                q = (db.collection("comandas")
+                     .where("espacio", "in", ordered[i:i + 30])
+                     .where("estado", "==", "ABIERTA")
+                     .order_by("created_at"))
+                docs.update({d.id: d.to_dict() or {} for d in q.stream()})
+        except Exception as e:
+            st.error(f"No fue posible cargar la cola: {e}")
+    rows = {doc_id: dict(row, id=doc_id) for doc_id, row in docs.items() if row.get("espacio") in names}
+    for op, payload in sync_journal().pending("abrir_comanda", "cobrar", "cancelar_comanda"):
+        if op == "abrir_comanda" and payload["data"].get("espacio") in names:
+            rows.setdefault(payload["id"], dict(payload["data"], id=payload["id"]))
+        elif op != "abrir_comanda":
+            rows.pop(payload["cid"], None)
+    return sorted(rows.values(), key=lambda r: r.get("created_at", ""))
+
+
+def order_number(order: dict) -> str:
+    return f"#{int(order['numero']):03d}" if order.get("numero") else f"#{order['id'][:4].upper()}"
+
+
+def commit_writes(writes, chunk: int = 500) -> int:
+    """Aplica (op, ref, data) con op en {"set", "merge", "update", "delete"} en lotes de hasta 500.
+
+    Hasta 500 escrituras van en un solo lote atómico; si son más, los lotes
+    se aplican en el orden de la lista.
+    """
+    batch, pending, total = db.batch(), 0, 0
+    for op, ref, data in writes:
+        if op == "delete":
+            batch.delete(ref)
+        elif op == "update":
+            batch.update(ref, data)
+        elif op == "merge":
+            batch.set(ref, data, merge=True)
+        else:
+            batch.set(ref, data)
+        pending += 1
+        if pending == chunk:
+            batch.commit()
+            total += pending
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        total += pending
+    return total
+
+
+# ---------------------------
+# CACHÉ DE COMANDAS
+# ---------------------------
+# Cada sesión guarda sus comandas en st.session_state.order_cache y las
+# escrituras (add/remove/set_order_item, open_new_order) la mantienen al día. El registro compartido por proceso guarda la última
+# versión conocida de cada comanda para detectar ediciones hechas desde
+# otra tableta.
+ORDER_CACHE_MAX_AGE = 20  # segundos antes de volver a confirmar contra Firestore
+
+
+@st.cache_resource
+def _order_versions() -> dict:
+    return {}
+
+
+def _order_stamp(order: dict) -> tuple:
+    return int(order.get("version", 0) or 0), str(order.get("updated_at", ""))
+
+
+def _remember_order_stamp(doc_id: str, stamp: tuple):
+    versions = _order_versions()
+    if stamp > versions.get(doc_id, (0, "")):
+        versions[doc_id] = stamp
+
+
+def _cache_order(order: dict):
+    order["_cached_at"] = time.monotonic()
+    st.session_state.order_cache[order["id"]] = order
+    _remember_order_stamp(order["id"], _order_stamp(order))
+
+
+def _order_is_stale(order: dict, live: bool = False) -> bool:
+    # Con el listener activo la comanda en memoria ya refleja las otras
+    # tabletas; sin él, se vuelve a leer pasado ORDER_CACHE_MAX_AGE.
+    if not live and time.monotonic() - order.get("_cached_at", 0) > ORDER_CACHE_MAX_AGE:
+        return True
+    return _order_versions().get(order["id"], (0, "")) > _order_stamp(order)
+
+
+def _normalize_order(doc_id: str, data: dict, update_time=None) -> dict:
+    row = dict(data)
+    row["id"] = doc_id
+    row.setdefault("items", [])
+    row["total"] = calc_total(row["items"])
+    if update_time is not None and row.get("estado") == "ABIERTA":
+        # Última versión confirmada por Firestore: base del compare-and-set de
+        # update_order(). El write-through local no la mueve.
+        row["_base"] = {"items": list(row["items"]), "update_time": update_time}
+    return row
+
+
+def forget_order(doc_id: str):
+    st.session_state.order_cache.pop(doc_id, None)
+
+
+def replay_order_ops(order: dict, ops: list) -> dict:
+    """Aplica a la comanda los renglones del diario que aún no llegan a Firestore.
+
+    Los renglones se comparan por lid, así da igual si la base ya traía
+    alguno (caché con write-through, o Firestore a medio sincronizar).
+    """
+    items = list(order.get("items", []))
+    for op, payload in ops:
+        if op == "agregar_item":
+            items = _with_lines(items, [payload["item"]])
+        elif op == "quitar_item":
+            items = _without_line(items, payload["lid"])
+        elif op == "cantidad_item":
+            items = _with_quantity(items, payload["lid"], payload["q"])
+    return dict(order, items=items, total=calc_total(items))
 
 
 def load_order(doc_id: str) -> dict:
+    pending = sync_journal().pending_for(doc_id)
+    cached = st.session_state.order_cache.get(doc_id)
+    _, live_orders, live_times = live_snapshot(_open_orders_live) or (0, {}, {})
+    live = live_orders.get(doc_id)
+    live_time = live_times.get(doc_id)
+    # Sin cambios en cola, el listener manda en cuanto su update_time difiere
+    # de la base en caché: el write-through deja versión y updated_at iguales
+    # a lo que luego confirma Firestore, así que comparar solo el sello nunca
+    # renovaría la base del compare-and-set (ni se la daría a una comanda
+    # abierta en esta terminal).
+    cached_time = ((cached or {}).get("_base") or {}).get("update_time")
+    if live is not None and (cached is None or _order_stamp(live) > _order_stamp(cached)
+                             or (not pending and live_time is not None and live_time != cached_time)):
+        cached = _normalize_order(doc_id, live, live_time)
+        _cache_order(cached)
+    if pending:
+        # Con cambios en cola no se consulta Firestore (sin red se
+        # bloquearía y además no los trae): base local + diario.
+        opened = next((p["data"] for op, p in pending if op == "abrir_comanda"), None)
+        if cached is None and opened is not None:
+            cached = _normalize_order(doc_id, opened)
+        if cached is None:
+            return {"id": doc_id, "items": [], "total": 0, "incompleta": True}
+        return replay_order_ops(cached, pending)
+    if cached and not _order_is_stale(cached, live=live is not None):
+        return dict(cached, items=list(cached["items"]))
     try:
         doc = db.collection("comandas").document(doc_id).get()
         if doc.exists:
-            row = doc.to_dict() or {}
-            row["id"] = doc.id
-            row.setdefault("items", [])
-            row.setdefault("total", 0)
-            return row
+            row = _normalize_order(doc.id, doc.to_dict() or {}, doc.update_time)
+            _cache_order(row)
+            return dict(row, items=list(row["items"]))
     except Exception as e:
         st.error(f"No fue posible cargar la comanda: {e}")
     return {"id": doc_id, "items": [], "total": 0}
 
 
-def update_order(doc_id: str, items: list, total: float):
-    db.collection("comandas").document(doc_id).update({"items": items, "total": total, "updated_at": now_iso()})
+def _write_through(doc_id: str, items: list, total: float, updated_at: str):
+    cached = st.session_state.order_cache.get(doc_id)
+    if cached:
+        version, _ = _order_stamp(cached)
+        _cache_order(dict(cached, items=items, total=total, updated_at=updated_at, version=version + 1))
+
+
+# Compare-and-set por renglón. Cada cambio (agregar, quitar, cambiar
+# cantidad) es una función sobre la lista de renglones que se aplica a la
+# última versión conocida y se escribe con la precondición last_update_time.
+# Si otra tableta escribió antes, la precondición falla, se relee y la misma
+# función se aplica sobre lo que hay: como cada renglón lleva su lid, los
+# cambios de ambas se fusionan sin perder ninguno, y volver a aplicar uno
+# que ya estaba no lo duplica.
+class OrderClosed(SyncConflict):
+    """La comanda ya no está abierta; lleva el documento leído."""
+
+    def __init__(self, ref, row: dict):
+        super().__init__("La comanda ya estaba cerrada.")
+        self.ref, self.row = ref, row
+
+
+def _with_lines(items: list, lines: list) -> list:
+    lids = {x.get("lid") for x in items}
+    return items + [x for x in lines if x.get("lid") not in lids]
+
+
+# Renglones anteriores a los lid no se pueden señalar uno por uno: sin lid
+# quitar o cambiar cantidad no hace nada (la pantalla deshabilita los botones).
+def _without_line(items: list, lid: str) -> list:
+    return [x for x in items if lid is None or x.get("lid") != lid]
+
+
+def _with_quantity(items: list, lid: str, qty: int) -> list:
+    return [dict(x, q=int(qty)) if lid is not None and x.get("lid") == lid else x for x in items]
+
+
+def encode_order_base(order: dict):
+    base = (order or {}).get("_base")
+    if not base:
+        return None
+    return {"items": base["items"], "update_time": stamp_text(base["update_time"])}
+
+
+def update_order(doc_id: str, mutate=None, base: dict = None, updated_at: str = None, retries: int = 5,
+                 extra: dict = None, append: list = None) -> dict:
+    """Aplica un cambio de renglones con compare-and-set sobre el update_time de la comanda.
+
+    base ({"items", "update_time"}) es la versión que tenía en caché la
+    terminal que encoló el cambio; con ella no hace falta leer. Sin base, o si
+    la precondición falla, se lee la comanda y se reintenta. Devuelve la nueva
+    base; extra son campos adicionales para la misma escritura.
+
+    append agrega renglones con ArrayUnion: la escritura mide lo mismo sin
+    importar el largo de la comanda. Quitar o cambiar cantidad (mutate) sí
+    reescribe la lista completa; la precondición es la que evita pisar a otra
+    tableta. El total de una comanda abierta no se guarda: se calcula de sus
+    renglones al leerla.
+    """
+    ref = db.collection("comandas").document(doc_id)
+    for _ in range(retries):
+        fresh = base is None
+        if fresh:
+            snap = ref.get()
+            if not snap.exists:
+                raise SyncConflict("La comanda no existe.")
+            row = snap.to_dict() or {}
+            if row.get("estado") != "ABIERTA":
+                raise OrderClosed(ref, row)
+            base = {"items": row.get("items", []), "update_time": snap.update_time}
+        if append is not None:
+            lids = {x.get("lid") for x in base["items"]}
+            new = [x for x in append if x.get("lid") not in lids]
+            items = base["items"] + new
+            changes = {"items": firestore.ArrayUnion(new)} if new else {}
+        else:
+            items = mutate(list(base["items"]))
+            changes = {"items": items} if items != base["items"] else {}
+        if not changes and not extra:
+            return base  # ya estaba aplicado
+        try:
+            result = ref.update({
+                **changes,
+                "updated_at": updated_at or now_iso(),
+                "version": firestore.Increment(1),
+                **(extra or {}),
+            }, option=db.write_option(last_update_time=base["update_time"]))
+        except gexc.FailedPrecondition:
+            base = None
+            continue
+        return {"items": items, "update_time": result.update_time}
+    raise gexc.Aborted("La comanda cambió en cada intento; se reintentará.")
+
+
+def _queued_base(doc_id: str):
+    base = encode_order_base(st.session_state.order_cache.get(doc_id))
+    if base is not None and sync_journal().pending_for(doc_id):
+        # Con cambios previos aún en cola la base ya no es la última versión;
+        # el hilo la relee al aplicar este cambio.
+        return None
+    return base
+
+
+def _enqueue_line_op(op: str, doc_id: str, payload: dict, items_after) -> str:
+    updated_at = now_iso()
+    base = _queued_base(doc_id)
+    enqueue_write(op, {"cid": doc_id, **payload, "updated_at": updated_at, "base": base})
+    cached = st.session_state.order_cache.get(doc_id)
+    if cached:
+        items = items_after(cached["items"])
+        _write_through(doc_id, items, calc_total(items), updated_at)
+    return updated_at
+
+
+# Los cambios se encolan localmente y el hilo de sincronización los aplica
+# con update_order().
+def add_order_item(doc_id: str, item: dict) -> dict:
+    item = dict(item)
+    item.setdefault("lid", uuid.uuid4().hex[:12])
+    _enqueue_line_op("agregar_item", doc_id, {"item": item}, lambda items: _with_lines(items, [item]))
+    return item
+
+
+def remove_order_item(doc_id: str, item: dict):
+    lid = item.get("lid")
+    _enqueue_line_op("quitar_item", doc_id, {"lid": lid}, lambda items: _without_line(items, lid))
+
+
+def set_order_item_qty(doc_id: str, item: dict, qty: int):
+    lid = item.get("lid")
+    _enqueue_line_op("cantidad_item", doc_id, {"lid": lid, "q": int(qty)},
+                     lambda items: _with_quantity(items, lid, qty))
+
+
+# Renglones que llegan después de cobrar (otra tableta, o un agregado que
+# sincronizó tarde) no se pierden: pasan a una comanda de continuación abierta
+# en el mismo espacio, con id fijo "<comanda>-sig" para que todas las
+# terminales coincidan. Si la continuación también se cerró, siguen a la suya.
+def continuation_ref(order_ref):
+    return order_ref.parent.document(f"{order_ref.id}-sig")
+
+
+def _carry_over(order_ref, row: dict, lines: list, updated_at: str):
+    cont_ref = continuation_ref(order_ref)
+    # Lo que cocina ya marcó listo sigue listo en la continuación
+    lids = {x.get("lid") for x in lines}
+    bumped = {lid: v for lid, v in (row.get("cocina") or {}).items() if lid in lids}
+    try:
+        cont_ref.create({
+            "espacio": row.get("espacio", ""),
+            "estado": "ABIERTA",
+            "caja_id": row.get("caja_id", ""),
+            "fecha": updated_at,
+            "created_at": updated_at,
+            "updated_at": updated_at,
+            "origen": order_ref.id,
+            **({"numero": row["numero"]} if row.get("numero") else {}),
+            **({"cocina": bumped} if bumped else {}),
+            "items": lines,
+            "total": calc_total(lines),
+            "version": 1,
+        })
+        return
+    except gexc.AlreadyExists:
+        pass
+    try:
+        update_order(cont_ref.id, append=lines, updated_at=updated_at,
+                     extra={firestore.FieldPath("cocina", lid).to_api_repr(): v for lid, v in bumped.items()})
+    except OrderClosed as e:
+        if any(x.get("lid") not in {y.get("lid") for y in e.row.get("items", [])} for x in lines):
+            _carry_over(cont_ref, e.row, lines, updated_at)
+
+
+def _decode_base(payload: dict):
+    base = payload.get("base")
+    if not base:
+        return None
+    return {"items": base["items"], "update_time": stamp_value(base["update_time"])}
+
+
+def _apply_add_item(op_id: str, payload: dict):
+    item = payload["item"]
+    try:
+        update_order(payload["cid"], base=_decode_base(payload), updated_at=payload["updated_at"], append=[item])
+    except OrderClosed as e:
+        if not any(x.get("lid") == item.get("lid") for x in e.row.get("items", [])):
+            _carry_over(e.ref, e.row, [item], payload["updated_at"])
+
+
+def _apply_remove_item(op_id: str, payload: dict):
+    lid = payload["lid"]
+    update_order(payload["cid"], lambda items: _without_line(items, lid),
+                 _decode_base(payload), payload["updated_at"])
+
+
+def _apply_item_qty(op_id: str, payload: dict):
+    update_order(payload["cid"], lambda items: _with_quantity(items, payload["lid"], payload["q"]),
+                 _decode_base(payload), payload["updated_at"])
+
+
+def line_amount(item: dict) -> float:
+    return float(item.get("p", 0)) * int(item.get("q", 1))
 
 
 def calc_total(items: list) -> float:
-    return round(sum(float(x.get("p", 0)) * int(x.get("q", 1)) for x in items), 2)
+    return round(sum(line_amount(x) for x in items), 2)
 
 
 def build_sale_folio() -> str:
-    return f"KIN-{now_cdmx().strftime('%Y%m%d-%H%M%S')}-{str(uuid.uuid4())[:6].upper()}"
+    # Respaldo sin consecutivo para cuando no hay bloque reservado ni red. El
+    # prefijo KINR- lo distingue de los consecutivos KIN-AAAAMMDD-000123: no
+    # comparte su prefijo del día ni se intercala con ellos al ordenar.
+    return f"KINR-{now_cdmx().strftime('%Y%m%d-%H%M%S')}-{str(uuid.uuid4())[:6].upper()}"
+
+
+# ---------------------------
+# FOLIOS CONSECUTIVOS
+# ---------------------------
+# folios/{AAAAMMDD} lleva el siguiente número del día. Cada terminal reserva
+# bloques de FOLIO_BLOCK_SIZE con una transacción y los reparte localmente
+# (guardados en SQLite, sobreviven a reinicios), así el contador se toca una
+# vez por bloque y no en cada venta. Los bloques los reserva el hilo de
+# sincronización; tomar un folio solo lee SQLite y no espera a la red. Los folios KIN-AAAAMMDD-000123 son únicos
+# y ordenables; entre terminales puede haber huecos al cerrar el día. Sin
+# bloque se usa un folio de respaldo KINR-... (build_sale_folio).
+FOLIO_BLOCK_SIZE = 20
+FOLIO_PREFETCH = 10  # se reserva el siguiente bloque (en segundo plano) cuando quedan menos
+TURN_BLOCK_SIZE = 10
+TURN_PREFETCH = 3
+
+
+@firestore.transactional
+def _reserve_folio_block(transaction, counter_ref, day: str, size: int) -> int:
+    snap = counter_ref.get(transaction=transaction)
+    start = int((snap.to_dict() or {}).get("siguiente", 1)) if snap.exists else 1
+    transaction.set(counter_ref, {"dia": day, "siguiente": start + size, "updated_at": now_iso()})
+    return start
+
+
+class FolioAllocator:
+    """Reparte números consecutivos del día desde bloques reservados en Firestore."""
+
+    def __init__(self, path: str, collection: str = "folios", table: str = "folio_bloques",
+                 block_size: int = FOLIO_BLOCK_SIZE, prefetch: int = FOLIO_PREFETCH):
+        self.collection, self.table = collection, table
+        self.block_size, self.prefetch = block_size, prefetch
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                dia TEXT NOT NULL,
+                inicio INTEGER NOT NULL,
+                fin INTEGER NOT NULL,
+                siguiente INTEGER NOT NULL,
+                PRIMARY KEY (dia, inicio)
+            )
+        """)
+
+    def _available(self, day: str) -> int:
+        row = self._conn.execute(
+            f"SELECT COALESCE(SUM(fin - siguiente), 0) FROM {self.table} WHERE dia = ?", (day,)
+        ).fetchone()
+        return int(row[0])
+
+    def refill(self, day: str = None):
+        """Reserva un bloque si quedan menos de prefetch números del día.
+
+        Lo llama el hilo de sincronización (ver SyncWorker.tasks); la
+        transacción con Firestore corre fuera del candado, así cobrar nunca
+        espera a la red.
+        """
+        day = day or now_cdmx().strftime("%Y%m%d")
+        with self._lock:
+            if self._available(day) >= self.prefetch:
+                return
+        start = _reserve_folio_block(db.transaction(), db.collection(self.collection).document(day),
+                                     day, self.block_size)
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE dia < ?", (day,))
+            self._conn.execute(f"INSERT OR IGNORE INTO {self.table} VALUES (?, ?, ?, ?)",
+                               (day, start, start + self.block_size, start))
+
+    def next_number(self, day: str):
+        """Siguiente número del día desde SQLite, o None si no queda bloque reservado."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT inicio, siguiente FROM {self.table} WHERE dia = ? AND siguiente < fin ORDER BY inicio LIMIT 1",
+                    (day,),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(f"UPDATE {self.table} SET siguiente = siguiente + 1 WHERE dia = ? AND inicio = ?",
+                                       (day, row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row[1] if row is not None else None
+
+    def next_folio(self) -> str:
+        day = now_cdmx().strftime("%Y%m%d")
+        number = self.next_number(day)
+        return f"KIN-{day}-{number:06d}" if number is not None else build_sale_folio()
+
+
+@st.cache_resource
+def folio_allocator() -> FolioAllocator:
+    return FolioAllocator(LOCAL_DB_PATH)
+
+
+@st.cache_resource
+def turn_allocator() -> FolioAllocator:
+    # Números de pedido para espacios con cola (turnos/{AAAAMMDD})
+    return FolioAllocator(LOCAL_DB_PATH, "turnos", "turno_bloques", TURN_BLOCK_SIZE, TURN_PREFETCH)
+
+
+# ---------------------------
+# COBRO
+# ---------------------------
+def pending_sale_folio(doc_id: str) -> str:
+    """Folio reservado para cobrar la comanda; se reutiliza en cada reintento."""
+    pending = st.session_state.pending_sale
+    if not pending or pending["cid"] != doc_id:
+        pending = {"cid": doc_id, "folio": folio_allocator().next_folio()}
+        st.session_state.pending_sale = pending
+    return pending["folio"]
+
+
+@firestore.transactional
+def _checkout_txn(transaction, order_ref, sale_ref, cashbox_ref, sale: dict) -> tuple:
+    """Registra la venta y cierra la comanda.
+
+    Devuelve (comanda leída, renglones que pasan a la continuación).
+    """
+    sale_snap = sale_ref.get(transaction=transaction)
+    row = order_ref.get(transaction=transaction).to_dict() or {}
+    if sale_snap.exists:
+        # Reintento de un cobro que ya se registró; el traslado se repite
+        # por si no alcanzó a hacerse (es idempotente por lid).
+        return row, (row.get("trasladados", []) if row.get("venta_folio") == sale["folio"] else [])
+    unsold = []
+    if row.get("estado") != "ABIERTA":
+        # El dinero ya se recibió en esta terminal: la venta se registra igual
+        # (con caja y acumulados) y queda marcada para conciliarla a mano.
+        reason = (f"La comanda ya se había cobrado con el folio {row['venta_folio']}."
+                  if row.get("venta_folio") else "La comanda no estaba abierta en Firestore.")
+        transaction.create(sale_ref, stamped({**sale, "revisar": reason}))
+    else:
+        # Renglones que otra terminal agregó y que este cobro no incluyó
+        sold = {x.get("lid") for x in sale.get("items", [])}
+        unsold = [x for x in row.get("items", []) if x.get("lid") not in sold]
+
+        closed_at = now_iso()
+        transaction.create(sale_ref, stamped(sale))
+        closing = {
+            "estado": "CERRADA",
+            "closed_at": closed_at,
+            "venta_folio": sale["folio"],
+            "items": sale.get("items", []),
+            "total": sale["total"],
+            "updated_at": closed_at,
+            "version": firestore.Increment(1),
+        }
+        if unsold:
+            closing["continua_en"] = continuation_ref(order_ref).id
+            closing["trasladados"] = unsold
+        transaction.update(order_ref, closing)
+    transaction.update(cashbox_ref, stamped({
+        "ventas_total": firestore.Increment(sale["total"]),
+        "ventas_tickets": firestore.Increment(1),
+        firestore.FieldPath("ventas_por_metodo", sale["metodo"]).to_api_repr(): firestore.Increment(sale["total"]),
+    }))
+    day, fields = _sale_rollup(sale)
+    transaction.set(rollup_ref(day), {**rollup_keys(day), **_as_increments(fields)}, merge=True)
+    return row, unsold
+
+
+def checkout_order(doc_id: str, cashbox_id: str, sale: dict):
+    """Encola el cobro: venta, cierre de comanda y acumulados de caja en una transacción.
+
+    El folio es el id del documento de venta, así que reintentar con el mismo
+    folio nunca cobra dos veces.
+    """
+    enqueue_write("cobrar", {"cid": doc_id, "cashbox_id": cashbox_id, "sale": sale})
+
+
+def _apply_checkout(op_id: str, payload: dict):
+    sale = payload["sale"]
+    order_ref = db.collection("comandas").document(payload["cid"])
+    row, unsold = _checkout_txn(
+        db.transaction(),
+        order_ref,
+        db.collection("ventas").document(sale["folio"]),
+        db.collection("cajas").document(payload["cashbox_id"]),
+        sale,
+    )
+    if unsold:
+        # Fuera de la transacción y con update_order(): si se corta aquí, el
+        # reintento del cobro lee "trasladados" y lo vuelve a intentar.
+        _carry_over(order_ref, row, unsold, sale["fecha"])
+
+
+# ---------------------------
+# CAJA — ACUMULADOS DEL TURNO
+# ---------------------------
+# El documento de la caja lleva los acumulados del turno. Ventas y egresos los
+# incrementan en la misma escritura, así la vista de Caja no recorre movimientos.
+def stamped(data: dict) -> dict:
+    """Agrega synced_at (hora del servidor) a escrituras de ventas, egresos y cajas.
+
+    La réplica local avanza por esa marca, así una venta que sincronizó tarde
+    o que trae la hora adelantada de otra terminal igual se copia.
+    """
+    return {**data, "synced_at": firestore.SERVER_TIMESTAMP}
+
+
+def empty_cashbox_aggregates() -> dict:
+    return {
+        "ventas_total": 0,
+        "ventas_tickets": 0,
+        "ventas_por_metodo": {},
+        "egresos_total": 0,
+        "egresos_count": 0,
+        "agregados": True,
+    }
+
+
+def open_cashbox(initial_fund: float, cash_user: str):
+    db.collection("cajas").add(stamped({
+        "monto_inicial": initial_fund,
+        "usuario": cash_user,
+        "estado": "ABIERTA",
+        "fecha": now_iso(),
+        "created_at": now_iso(),
+        **empty_cashbox_aggregates(),
+    }))
+
+
+def add_expense(cashbox_id: str, reason: str, amount: float):
+    enqueue_write("egreso", {
+        "id": db.collection("egresos").document().id,
+        "data": {
+            "caja_id": cashbox_id,
+            "motivo": reason,
+            "monto": amount,
+            "fecha": now_iso(),
+        },
+    })
+
+
+def _apply_expense(op_id: str, payload: dict):
+    data = payload["data"]
+    batch = db.batch()
+    batch.create(db.collection("egresos").document(payload["id"]), stamped(data))
+    batch.update(db.collection("cajas").document(data["caja_id"]), stamped({
+        "egresos_total": firestore.Increment(data["monto"]),
+        "egresos_count": firestore.Increment(1),
+    }))
+    try:
+        batch.commit()
+    except gexc.AlreadyExists:
+        pass  # ya se había registrado en un intento anterior
+
+
+@firestore.transactional
+def _rebuild_cashbox_txn(transaction, cashbox_ref) -> dict:
+    agg = empty_cashbox_aggregates()
+    for d in transaction.get(db.collection("ventas").where("caja_id", "==", cashbox_ref.id)):
+        row = d.to_dict() or {}
+        amount = float(row.get("total", 0))
+        method = row.get("metodo") or "Sin método"
+        agg["ventas_total"] += amount
+        agg["ventas_tickets"] += 1
+        agg["ventas_por_metodo"][method] = agg["ventas_por_metodo"].get(method, 0) + amount
+    for d in transaction.get(db.collection("egresos").where("caja_id", "==", cashbox_ref.id)):
+        agg["egresos_total"] += float((d.to_dict() or {}).get("monto", 0))
+        agg["egresos_count"] += 1
+    transaction.update(cashbox_ref, stamped(agg))
+    return agg
+
+
+def ensure_cashbox_aggregates(cashbox: dict) -> dict:
+    """Calcula una sola vez los acumulados de cajas abiertas antes de tenerlos."""
+    if cashbox.get("agregados"):
+        return cashbox
+    agg = _rebuild_cashbox_txn(db.transaction(), db.collection("cajas").document(cashbox["id"]))
+    return cashbox | agg
+
+
+# ---------------------------
+# RESÚMENES DIARIOS DE VENTAS
+# ---------------------------
+# ventas_diarias/{AAAA-MM-DD} acumula el día por método, espacio (cruzado con
+# método para poder filtrar por ambos), producto y hora. El cobro lo
+# incrementa y rebuild_daily_rollups() lo reconstruye desde ventas.
+def rollup_ref(day: str):
+    return db.collection("ventas_diarias").document(day)
+
+
+def _sale_rollup(sale: dict) -> tuple:
+    # Las ventas nuevas traen sus cubetas; solo las antiguas se parsean
+    buckets = sale if "hora" in sale and "dia" in sale else time_buckets(datetime.fromisoformat(sale["fecha"]))
+    total = float(sale.get("total", 0))
+    method = sale.get("metodo") or "Sin método"
+    space = sale.get("mesa") or "Sin mesa"
+    products = {}
+    for x in sale.get("items", []):
+        # Por id de producto: "n" es solo una copia del nombre y cambia si se
+        # renombra en el catálogo. Las líneas antiguas sin "pid" usan el nombre.
+        row = products.setdefault(x.get("pid") or x.get("n") or "Producto", {"cantidad": 0, "total": 0.0})
+        row["cantidad"] += int(x.get("q", 1))
+        row["total"] += line_amount(x)
+    fields = {
+        "total": total,
+        "tickets": 1,
+        "metodos": {method: {"total": total, "tickets": 1}},
+        "espacios": {space: {method: {"total": total, "tickets": 1}}},
+        "productos": products,
+        "horas": {f"{int(buckets['hora']):02d}": {"total": total, "tickets": 1}},
+    }
+    return buckets["dia"], fields
+
+
+def rollup_keys(day: str) -> dict:
+    """Campos fijos (no acumulables) del resumen del día."""
+    return {"dia": day, "dow": date.fromisoformat(day).isoweekday()}
+
+
+def _merge_rollup(acc: dict, fields: dict):
+    for k, v in fields.items():
+        if isinstance(v, dict):
+            _merge_rollup(acc.setdefault(k, {}), v)
+        else:
+            acc[k] = acc.get(k, 0) + v
+
+
+def _as_increments(fields: dict) -> dict:
+    return {k: _as_increments(v) if isinstance(v, dict) else firestore.Increment(v) for k, v in fields.items()}
+
+
+def rebuild_daily_rollups(start: date, end: date) -> int:
+    """Recalcula los resúmenes de [start, end] desde ventas. Devuelve días con ventas."""
+    days = {}
+    q = (db.collection("ventas")
+         .where("fecha", ">=", start.isoformat())
+         .where("fecha", "<", (end + timedelta(days=1)).isoformat()))
+    for d in q.stream():
+        sale = d.to_dict() or {}
+        if sale.get("fecha"):
+            day, fields = _sale_rollup(sale)
+            _merge_rollup(days.setdefault(day, {}), fields)
+
+    all_days = [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+    commit_writes(
+        ("set", rollup_ref(day), {**rollup_keys(day), **days[day]}) if day in days else ("delete", rollup_ref(day), None)
+        for day in all_days
+    )
+    load_daily_rollups.clear()
+    return len(days)
+
+
+@st.cache_data(ttl=60)
+def load_daily_rollups(start: date, end: date) -> list:
+    q = (db.collection("ventas_diarias")
+         .where("dia", ">=", start.isoformat())
+         .where("dia", "<=", end.isoformat()))
+    return [d.to_dict() or {} for d in q.stream()]
+
+
+WEEKDAYS = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
+
+
+def hourly_heatmap(rollups: list, metric: str = "tickets") -> pd.DataFrame:
+    """Tabla larga (día de la semana × hora) sumando las cubetas "horas" de los resúmenes."""
+    cells = {}
+    for r in rollups:
+        dow = r.get("dow") or date.fromisoformat(r["dia"]).isoweekday()
+        for hour, v in (r.get("horas") or {}).items():
+            key = (dow, int(hour))
+            cells[key] = cells.get(key, 0) + v.get(metric, 0)
+    return pd.DataFrame(
+        [{"dia": WEEKDAYS[dow - 1], "dow": dow, "hora": hour, metric: value} for (dow, hour), value in cells.items()],
+        columns=["dia", "dow", "hora", metric],
+    )
+
+
+# ---------------------------
+# RÉPLICA LOCAL DE VENTAS (SQLITE)
+# ---------------------------
+# ventas, egresos y cajas se copian de forma incremental a SQLite. La marca de
+# agua es (synced_at, id): synced_at lo escribe el servidor en cada escritura
+# (ver stamped()), así no se pierden ventas que sincronizaron tarde ni las de
+# una terminal con el reloj movido. Reporte y Caja agregan con SQL sobre la
+# copia y solo consultan Firestore para traer lo nuevo.
+REPLICA_SYNC_INTERVAL = 30  # segundos entre sincronizaciones automáticas
+REPLICA_PAGE_SIZE = 500
+SALES_PAGE_SIZE = 50
+
+
+def fetch_page(query, cursor=None, page_size: int = REPLICA_PAGE_SIZE) -> tuple:
+    """Devuelve (documentos de la página con su "id", cursor de la siguiente o None)."""
+    if cursor is not None:
+        query = query.start_after(cursor)
+    docs = list(query.limit(page_size + 1).stream())
+    has_next = len(docs) > page_size
+    docs = docs[:page_size]
+    return [dict(d.to_dict() or {}, id=d.id) for d in docs], (docs[-1] if has_next else None)
+
+
+def iter_query(query, page_size: int = REPLICA_PAGE_SIZE):
+    cursor = None
+    while True:
+        rows, cursor = fetch_page(query, cursor, page_size)
+        yield from rows
+        if cursor is None:
+            return
+
+
+def stamp_text(ts) -> str:
+    # RFC 3339 con nanosegundos: la marca vuelve a Firestore sin perder precisión
+    return ts.rfc3339() if hasattr(ts, "rfc3339") else ts.isoformat()
+
+
+def stamp_value(text: str):
+    try:
+        return DatetimeWithNanoseconds.from_rfc3339(text)
+    except ValueError:
+        return datetime.fromisoformat(text)
+
+
+def sale_day(fecha) -> str:
+    try:
+        return datetime.fromisoformat(fecha).astimezone(CDMX_TZ).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return ""
+
+
+class SalesReplica:
+    """Copia local de ventas, egresos y cajas para reportes sin ir a Firestore."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_sync = 0.0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ventas (
+                id TEXT PRIMARY KEY, folio TEXT, fecha TEXT, dia TEXT, mesa TEXT, metodo TEXT,
+                caja_id TEXT, total REAL, nota TEXT, items TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ventas_dia ON ventas (dia);
+            CREATE INDEX IF NOT EXISTS ventas_fecha ON ventas (fecha, id);
+            CREATE INDEX IF NOT EXISTS ventas_caja ON ventas (caja_id);
+            CREATE TABLE IF NOT EXISTS egresos (
+                id TEXT PRIMARY KEY, caja_id TEXT, fecha TEXT, dia TEXT, motivo TEXT, monto REAL
+            );
+            CREATE INDEX IF NOT EXISTS egresos_caja ON egresos (caja_id);
+            CREATE TABLE IF NOT EXISTS cajas (
+                id TEXT PRIMARY KEY, fecha TEXT, estado TEXT, usuario TEXT, monto_inicial REAL, data TEXT
+            );
+            CREATE TABLE IF NOT EXISTS replica_cursores (coleccion TEXT PRIMARY KEY, synced_at TEXT, doc_id TEXT);
+        """)
+
+    @staticmethod
+    def _sale_row(row: dict) -> tuple:
+        return (
+            row["id"], row.get("folio", ""), row.get("fecha", ""), sale_day(row.get("fecha")),
+            row.get("mesa", ""), row.get("metodo", ""), row.get("caja_id", ""),
+            float(row.get("total", 0) or 0), row.get("nota") or "",
+            json.dumps(row.get("items") or [], ensure_ascii=False),
+        )
+
+    @staticmethod
+    def _expense_row(row: dict) -> tuple:
+        return (
+            row["id"], row.get("caja_id", ""), row.get("fecha", ""), sale_day(row.get("fecha")),
+            row.get("motivo", ""), float(row.get("monto", 0) or 0),
+        )
+
+    @staticmethod
+    def _cashbox_row(row: dict) -> tuple:
+        return (
+            row["id"], row.get("fecha", ""), row.get("estado", ""), row.get("usuario", ""),
+            float(row.get("monto_inicial", 0) or 0), json.dumps(row, ensure_ascii=False, default=str),
+        )
+
+    def _write(self, table: str, rows: list, cursor: tuple = None):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if rows:
+                    marks = ",".join("?" * len(rows[0]))
+                    self._conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({marks})", rows)
+                if cursor is not None:
+                    self._conn.execute("INSERT OR REPLACE INTO replica_cursores VALUES (?, ?, ?)", (table, *cursor))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _copy_pages(self, table: str, query, mapper, cursor_of):
+        rows, cursor = [], None
+        for row in iter_query(query):
+            rows.append(mapper(row))
+            cursor = cursor_of(row) or cursor
+            if len(rows) == REPLICA_PAGE_SIZE:
+                self._write(table, rows, cursor)
+                rows = []
+        if rows:
+            self._write(table, rows, cursor)
+
+    def _sync_collection(self, table: str, mapper):
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT synced_at, doc_id FROM replica_cursores WHERE coleccion = ?", (table,)
+            ).fetchone()
+        ref = db.collection(table)
+        if found is None:
+            # Primera copia: toda la colección por id (también documentos
+            # anteriores a synced_at). La hora del servidor se toma antes de
+            # empezar; lo escrito mientras tanto se vuelve a traer después.
+            start = db.collection("config").document("replica_reloj").set(
+                {"ahora": firestore.SERVER_TIMESTAMP}).update_time
+            self._copy_pages(table, ref.order_by(firestore.FieldPath.document_id()), mapper, lambda row: None)
+            self._write(table, [], (stamp_text(start), ""))
+            found = (stamp_text(start), "")
+
+        synced_at, doc_id = found
+        q = ref.order_by("synced_at").order_by(firestore.FieldPath.document_id())
+        q = q.start_after((stamp_value(synced_at), ref.document(doc_id))) if doc_id else q.start_at((stamp_value(synced_at),))
+        self._copy_pages(table, q, mapper, lambda row: (stamp_text(row["synced_at"]), row["id"]))
+
+    def sync(self, force: bool = False) -> bool:
+        """Trae de Firestore solo lo nuevo; a lo más una vez por REPLICA_SYNC_INTERVAL."""
+        if not force and time.monotonic() - self.last_sync < REPLICA_SYNC_INTERVAL:
+            return False
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            self._sync_collection("ventas", self._sale_row)
+            self._sync_collection("egresos", self._expense_row)
+            self._sync_collection("cajas", self._cashbox_row)
+            self.last_sync = time.monotonic()
+            return True
+        finally:
+            self._sync_lock.release()
+
+    def query_df(self, sql: str, params=()) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query(sql, self._conn, params=list(params))
+
+    def iter_sales(self, where: str, params=()):
+        # Conexión propia para no bloquear a las demás sesiones mientras se exporta.
+        conn = sqlite3.connect(self.path)
+        try:
+            cur = conn.execute(
+                f"SELECT folio, fecha, mesa, metodo, caja_id, total, nota, items FROM ventas WHERE {where} ORDER BY fecha",
+                list(params),
+            )
+            while True:
+                rows = cur.fetchmany(REPLICA_PAGE_SIZE)
+                if not rows:
+                    return
+                for folio, fecha, mesa, metodo, caja_id, total, nota, items in rows:
+                    yield {
+                        "folio": folio, "fecha": fecha, "mesa": mesa, "metodo": metodo,
+                        "caja_id": caja_id, "total": total, "nota": nota, "items": json.loads(items or "[]"),
+                    }
+        finally:
+            conn.close()
+
+
+@st.cache_resource
+def sales_replica() -> SalesReplica:
+    return SalesReplica(LOCAL_DB_PATH)
+
+
+def replica_filters(start: date, end: date, methods: list = None, spaces: list = None) -> tuple:
+    """Cláusula WHERE y parámetros para ventas de la réplica."""
+    clauses, params = ["dia BETWEEN ? AND ?"], [start.isoformat(), end.isoformat()]
+    if methods:
+        clauses.append(f"metodo IN ({','.join('?' * len(methods))})")
+        params += list(methods)
+    if spaces:
+        clauses.append(f"mesa IN ({','.join('?' * len(spaces))})")
+        params += list(spaces)
+    return " AND ".join(clauses), params
+
+
+# ---------------------------
+# EXPORTACIÓN DE VENTAS
+# ---------------------------
+# Las ventas se leen por bloques y se escriben al vuelo a un archivo temporal,
+# una fila por producto vendido; la memoria no crece con el rango.
+EXPORT_PAGE_SIZE = 500
+EXPORT_COLUMNS = [
+    "folio", "fecha", "mesa", "metodo", "caja_id",
+    "producto_id", "producto", "cantidad", "precio", "importe", "total_venta", "nota",
+]
+
+
+def iter_sale_lines(sales):
+    for sale in sales:
+        head = {
+            "folio": sale.get("folio", ""),
+            "fecha": sale.get("fecha", ""),
+            "mesa": sale.get("mesa", ""),
+            "metodo": sale.get("metodo", ""),
+            "caja_id": sale.get("caja_id", ""),
+            "total_venta": float(sale.get("total", 0)),
+            "nota": sale.get("nota", "") or "",
+        }
+        items = sale.get("items") or []
+        if not items:
+            yield head | {"producto_id": "", "producto": "", "cantidad": 0, "precio": 0.0, "importe": 0.0}
+        for x in items:
+            yield head | {
+                "producto_id": x.get("pid", ""),
+                "producto": x.get("n", ""),
+                "cantidad": int(x.get("q", 1)),
+                "precio": float(x.get("p", 0)),
+                "importe": line_amount(x),
+            }
+
+
+def _write_parquet(lines, path: str):
+    schema = pa.schema([
+        (c, pa.float64() if c in ("precio", "importe", "total_venta") else pa.int64() if c == "cantidad" else pa.string())
+        for c in EXPORT_COLUMNS
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == EXPORT_PAGE_SIZE:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+
+
+def export_sales(sales, fmt: str = "csv") -> str:
+    """Exporta un iterable de ventas a un archivo temporal y devuelve su ruta."""
+    fd, path = tempfile.mkstemp(prefix="kin_ventas_", suffix=f".{fmt}")
+    lines = iter_sale_lines(sales)
+    if fmt == "parquet":
+        os.close(fd)
+        _write_parquet(lines, path)
+    else:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8-sig") as fh:
+            writer = csv.DictWriter(fh, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(lines)
+    return path
 
 
 # ---------------------------
 # CATÁLOGO — HELPERS FIRESTORE
 # ---------------------------
+# Un documento por producto en catalogo/{id} (con categoria, seccion y orden)
+# y un manifiesto en config/catalog_meta con el orden de categorías/secciones
+# y la versión. Cada edición escribe solo el producto que cambió.
+def catalog_meta_ref():
+    return db.collection("config").document("catalog_meta")
+
+
+def catalog_product_ref(pid: str):
+    return db.collection("catalogo").document(pid)
+
+
+def _read_catalog_meta() -> dict:
+    docs = live_docs(_catalog_meta_live)
+    if docs is not None:
+        return docs.get("catalog_meta") or {}
+    doc = catalog_meta_ref().get()
+    return (doc.to_dict() or {}) if doc.exists else {}
+
+
+def _read_legacy_catalog() -> dict:
+    doc = db.collection("config").document("catalog").get()
+    return (doc.to_dict() or {}) if doc.exists else {}
+
+
+def _catalog_structure(catalog: dict) -> list:
+    return [{"nombre": cat, "secciones": list((sections or {}).keys())} for cat, sections in catalog.items()]
+
+
+def _catalog_version_fields(**fields) -> dict:
+    return {"version": firestore.Increment(1), "updated_at": now_iso(), **fields}
+
+
+def _bump_catalog_version(batch, **fields):
+    batch.set(catalog_meta_ref(), _catalog_version_fields(**fields), merge=True)
+
+
 def get_catalog_from_db() -> dict:
-    """Lee el catálogo desde Firestore. Si no existe, siembra el catálogo base."""
-    try:
-        doc = db.collection("config").document("catalog").get()
-        if doc.exists:
-            return doc.to_dict() or {}
-    except Exception:
-        pass
-    return {}
+    """Arma el árbol categoría → sección → productos desde el manifiesto y catalogo/*.
+
+    Solo lee: si aún no hay manifiesto devuelve el documento config/catalog
+    anterior o el catálogo base; la siembra la hace ensure_catalog_tree().
+    """
+    meta = _read_catalog_meta()
+    if "estructura" not in meta:
+        return _normalize_catalog(_read_legacy_catalog() or DEFAULT_CATALOG)[0]
+
+    tree = {c["nombre"]: {sec: [] for sec in c.get("secciones", [])} for c in meta["estructura"]}
+    for d in db.collection("catalogo").stream():
+        row = d.to_dict() or {}
+        category = row.pop("categoria", "Sin categoría")
+        section = row.pop("seccion", "General")
+        tree.setdefault(category, {}).setdefault(section, []).append({**row, "id": d.id})
+    for sections in tree.values():
+        for prods in sections.values():
+            prods.sort(key=lambda p: (p.get("orden", 0), p.get("name", "")))
+    return tree
+
+
+def _normalize_catalog(catalog: dict, known_ids: dict = None) -> tuple:
+    """Asigna id y orden a cada producto. Devuelve (árbol con ids, {id: documento})."""
+    known_ids = known_ids or {}
+    tree, rows = {}, {}
+    for category, sections in catalog.items():
+        tree[category] = {}
+        for section, prods in (sections or {}).items():
+            tree[category][section] = []
+            for orden, prod in enumerate(p for p in prods if isinstance(p, dict)):
+                name = prod.get("name", "")
+                pid = prod.get("id") or known_ids.get((category, section, name))
+                if not pid or pid in rows:
+                    pid = unique_product_id(category, section, name, rows)
+                row = {k: v for k, v in prod.items() if k not in ("id", "categoria", "seccion")}
+                row["orden"] = orden
+                tree[category][section].append({**row, "id": pid})
+                rows[pid] = {**row, "categoria": category, "seccion": section}
+    return tree, rows
+
+
+def write_catalog_tree(catalog: dict) -> dict:
+    """Reemplaza el catálogo completo (semilla, restaurar). Devuelve el árbol con ids.
+
+    Productos, manifiesto y bajas van en un solo lote. Si no caben, el
+    manifiesto se escribe después de todos los productos y antes de borrar
+    los que sobran, así un corte a la mitad nunca deja un manifiesto nuevo
+    sin sus productos.
+    """
+    tree, rows = _normalize_catalog(catalog)
+    stale = [d.reference for d in db.collection("catalogo").select([firestore.FieldPath.document_id()]).stream()
+             if d.id not in rows]
+    commit_writes([("set", catalog_product_ref(pid), row) for pid, row in rows.items()]
+                  + [("merge", catalog_meta_ref(), _catalog_version_fields(estructura=_catalog_structure(tree)))]
+                  + [("delete", ref, None) for ref in stale])
+    return tree
+
+
+def duplicate_product_name(products: list, name: str, pid: str = None) -> bool:
+    name = name.strip().lower()
+    return any(
+        isinstance(p, dict) and p.get("id") != pid and str(p.get("name", "")).strip().lower() == name
+        for p in products
+    )
+
+
+def save_catalog_product(category: str, section: str, prod: dict) -> str:
+    pid = prod.get("id") or uuid.uuid4().hex[:12]
+    row = {k: v for k, v in prod.items() if k != "id"}
+    batch = db.batch()
+    batch.set(catalog_product_ref(pid), {**row, "categoria": category, "seccion": section})
+    _bump_catalog_version(batch)
+    batch.commit()
+    return pid
+
+
+def delete_catalog_product(pid: str):
+    batch = db.batch()
+    batch.delete(catalog_product_ref(pid))
+    _bump_catalog_version(batch)
+    batch.commit()
+
+
+@firestore.transactional
+def _add_to_structure_txn(transaction, category: str, section: str = None):
+    meta = catalog_meta_ref().get(transaction=transaction).to_dict() or {}
+    structure = meta.get("estructura", [])
+    entry = next((c for c in structure if c["nombre"] == category), None)
+    if entry is None:
+        entry = {"nombre": category, "secciones": []}
+        structure.append(entry)
+    if section and section not in entry["secciones"]:
+        entry["secciones"].append(section)
+    transaction.set(catalog_meta_ref(), {
+        "estructura": structure,
+        "version": firestore.Increment(1),
+        "updated_at": now_iso(),
+    }, merge=True)
+
+
+def add_catalog_category(category: str):
+    _add_to_structure_txn(db.transaction(), category)
+
+
+def add_catalog_section(category: str, section: str):
+    _add_to_structure_txn(db.transaction(), category, section)
+
+
+# Cada escritura sube config/catalog_meta.version; un listener por proceso la
+# sigue y los cachés del catálogo se indexan por esa versión, así todas las
+# instancias ven los cambios al momento sin volver a leer por tiempo.
+CATALOG_FALLBACK_TTL = 30  # segundos, solo si el listener no está disponible
+
+
+@st.cache_resource
+def _catalog_meta_live() -> LiveQuery:
+    return LiveQuery(catalog_meta_ref())
+
+
+def get_catalog_version():
+    docs = live_docs(_catalog_meta_live)
+    if docs is None:
+        return f"ttl-{int(time.time() // CATALOG_FALLBACK_TTL)}"
+    return int((docs.get("catalog_meta") or {}).get("version", 0))
 
 
-def save_catalog_to_db(catalog: dict):
-    db.collection("config").document("catalog").set(catalog)
+# ---------------------------
+# CATÁLOGO — IMPORTACIÓN CON DIFERENCIAS
+# ---------------------------
+# Valida el JSON, lo compara producto por producto contra el catálogo actual y
+# escribe solo altas, cambios y bajas, en lotes de hasta 500 operaciones.
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_catalog(data) -> list:
+    """Devuelve los errores de forma del catálogo; lista vacía si es válido."""
+    if not isinstance(data, dict):
+        return ["La raíz debe ser un objeto {categoría: {sección: [productos]}}."]
+    errors = []
+    for category, sections in data.items():
+        if not isinstance(sections, dict):
+            errors.append(f"{category}: debe ser un objeto de secciones.")
+            continue
+        for section, prods in sections.items():
+            if not isinstance(prods, list):
+                errors.append(f"{category} › {section}: debe ser una lista de productos.")
+                continue
+            names = set()
+            for i, prod in enumerate(prods, start=1):
+                where = f"{category} › {section} #{i}"
+                if not isinstance(prod, dict):
+                    errors.append(f"{where}: el producto debe ser un objeto.")
+                    continue
+                name = str(prod.get("name", "")).strip()
+                if not name:
+                    errors.append(f"{where}: falta 'name'.")
+                elif name.lower() in names:
+                    errors.append(f"{where}: '{name}' está repetido en la sección.")
+                names.add(name.lower())
+                if not _is_number(prod.get("base")):
+                    errors.append(f"{where}: 'base' debe ser numérico.")
+                variants = prod.get("variants", [])
+                if not isinstance(variants, list) or not all(
+                    isinstance(v, dict) and str(v.get("label", "")).strip() and _is_number(v.get("extra", 0))
+                    for v in variants
+                ):
+                    errors.append(f"{where}: 'variants' debe ser una lista de {{label, extra}}.")
+                extras = prod.get("extras", [])
+                if not isinstance(extras, list) or not all(
+                    isinstance(x, dict) and str(x.get("label", "")).strip() and _is_number(x.get("price", 0))
+                    for x in extras
+                ):
+                    errors.append(f"{where}: 'extras' debe ser una lista de {{label, price}}.")
+                flavors = prod.get("flavors", [])
+                if not isinstance(flavors, list) or not all(isinstance(f, str) for f in flavors):
+                    errors.append(f"{where}: 'flavors' debe ser una lista de textos.")
+    return errors
+
+
+def diff_catalog(current: dict, incoming: dict) -> dict:
+    """Plan de importación: productos agregados, cambiados y eliminados."""
+    known_ids = {
+        (category, section, p.get("name", "")): p["id"]
+        for category, sections in current.items()
+        for section, prods in sections.items()
+        for p in prods if p.get("id")
+    }
+    _, old_rows = _normalize_catalog(current)
+    tree, new_rows = _normalize_catalog(incoming, known_ids)
+    return {
+        "version": get_catalog_version(),
+        "added": [pid for pid in new_rows if pid not in old_rows],
+        "changed": [pid for pid in new_rows if pid in old_rows and new_rows[pid] != old_rows[pid]],
+        "removed": [pid for pid in old_rows if pid not in new_rows],
+        "rows": new_rows,
+        "old_rows": old_rows,
+        "estructura": _catalog_structure(tree),
+    }
+
+
+def apply_catalog_import(plan: dict) -> int:
+    writes = [("set", catalog_product_ref(pid), plan["rows"][pid]) for pid in plan["added"] + plan["changed"]]
+    writes.append(("merge", catalog_meta_ref(), _catalog_version_fields(estructura=plan["estructura"])))
+    writes += [("delete", catalog_product_ref(pid), None) for pid in plan["removed"]]
+    return commit_writes(writes) - 1
 
 
 # ---------------------------
@@ -867,18 +2609,312 @@ DEFAULT_CATALOG = {
 }
 
 
-@st.cache_data(ttl=30)
+@st.cache_data(max_entries=4)
+def _load_catalog(version) -> dict:
+    return get_catalog_from_db()
+
+
 def get_catalog() -> dict:
-    db_cat = get_catalog_from_db()
-    if db_cat:
-        return db_cat
-    return DEFAULT_CATALOG
+    try:
+        return _load_catalog(get_catalog_version())
+    except Exception:
+        return DEFAULT_CATALOG
+
+
+def product_id(category: str, section: str, name: str) -> str:
+    return hashlib.sha1(f"{category}|{section}|{name}".encode("utf-8")).hexdigest()[:12]
+
+
+def unique_product_id(category: str, section: str, name: str, taken) -> str:
+    # Dos productos con el mismo nombre en la sección no comparten id: el
+    # segundo lleva la posición ("#2", "#3"...) en el hash.
+    pid, n = product_id(category, section, name), 1
+    while pid in taken:
+        n += 1
+        pid = product_id(category, section, f"{name}#{n}")
+    return pid
+
+
+def build_catalog_index(catalog: dict) -> dict:
+    """Tabla plana de productos activos con id estable y rebanadas por categoría."""
+    products, tabs = {}, {}
+    for category, sections in catalog.items():
+        tab_sections = []
+        for section, prods in (sections or {}).items():
+            pids = []
+            for prod in prods:
+                if not isinstance(prod, dict) or not prod.get("active", True):
+                    continue
+                pid = prod.get("id")
+                if not pid or pid in products:
+                    pid = unique_product_id(category, section, prod.get("name", ""), products)
+                products[pid] = {**prod, "id": pid, "category": category, "section": section}
+                pids.append(pid)
+            if pids:
+                tab_sections.append((section, pids))
+        tabs[category] = tab_sections
+    return {"products": products, "tabs": tabs}
+
+
+@st.cache_resource(max_entries=4)
+def _catalog_index(version) -> dict:
+    return build_catalog_index(_load_catalog(version))
+
+
+def get_catalog_index() -> dict:
+    try:
+        return _catalog_index(get_catalog_version())
+    except Exception:
+        return build_catalog_index(DEFAULT_CATALOG)
+
+
+def clear_catalog_caches():
+    # El listener tarda unos milisegundos en ver la nueva versión; la sesión
+    # que guarda limpia sus cachés para no mostrar el catálogo anterior.
+    _load_catalog.clear()
+    _catalog_index.clear()
+    _catalog_lookup.clear()
+
+
+@st.cache_resource
+def ensure_catalog_tree() -> bool:
+    """Siembra catalogo/* (migrando config/catalog) una vez por proceso si falta el manifiesto."""
+    docs = live_docs(_catalog_meta_live)
+    if docs is None:
+        # Sin snapshot no se sabe si falta; la excepción no se cachea y se
+        # vuelve a intentar en la siguiente ejecución.
+        raise RuntimeError("El manifiesto del catálogo aún no está disponible.")
+    if "estructura" not in (docs.get("catalog_meta") or {}):
+        write_catalog_tree(_read_legacy_catalog() or DEFAULT_CATALOG)
+        clear_catalog_caches()
+    return True
+
+
+try:
+    ensure_catalog_tree()
+except Exception:
+    pass  # sin red el menú usa el catálogo base de solo lectura
 
 
 def infer_price_from_variant(base: float, variant: dict) -> float:
     return float(base) + float(variant.get("extra", 0))
 
 
+# ---------------------------
+# LÍNEAS DE VENTA ESTRUCTURADAS
+# ---------------------------
+# Cada línea guarda la identidad del producto y no solo su nombre:
+#   {"lid", "pid", "v": índice de variante, "f": sabor, "x": [adicionales],
+#    "p": precio unitario, "q": cantidad, "n": nombre al momento de la venta}
+# "n" es solo una copia para lectura; las líneas antiguas sin "pid" se
+# convierten con migrate_line_items().
+ITEM_SEPARATOR = " · "
+
+
+def catalog_lookup(catalog: dict) -> tuple:
+    """({id: producto}, {nombre: producto}) con categoría, incluyendo inactivos."""
+    by_id, by_name = {}, {}
+    for category, sections in catalog.items():
+        for section, prods in (sections or {}).items():
+            for prod in prods:
+                if not isinstance(prod, dict):
+                    continue
+                pid = prod.get("id") or product_id(category, section, prod.get("name", ""))
+                row = {**prod, "id": pid, "category": category, "section": section}
+                by_id[pid] = row
+                by_name.setdefault(row.get("name", ""), row)
+    return by_id, by_name
+
+
+@st.cache_resource(max_entries=4)
+def _catalog_lookup(version) -> tuple:
+    return catalog_lookup(_load_catalog(version))
+
+
+def get_catalog_lookup() -> tuple:
+    try:
+        return _catalog_lookup(get_catalog_version())
+    except Exception:
+        return catalog_lookup(DEFAULT_CATALOG)
+
+
+def parse_item_name(name: str, by_name: dict) -> dict:
+    """Descompone un nombre "Producto · Variante · Sabor · Extra" (líneas antiguas)."""
+    parts = (name or "").split(ITEM_SEPARATOR)
+    prod = by_name.get(parts[0])
+    if prod is None:
+        return {"pid": "", "producto": parts[0], "categoria": "Sin catálogo", "variante": "", "sabor": "",
+                "extras": tuple(parts[1:]), "admite_extras": False}
+    variants = {v.get("label") for v in prod.get("variants", [])}
+    flavors = set(prod.get("flavors", []))
+    variant, flavor, extras = "", "", []
+    for part in parts[1:]:
+        if not variant and part in variants:
+            variant = part
+        elif not flavor and part in flavors:
+            flavor = part
+        else:
+            extras.append(part)
+    return {"pid": prod["id"], "producto": prod["name"], "categoria": prod["category"], "variante": variant,
+            "sabor": flavor, "extras": tuple(extras), "admite_extras": bool(prod.get("extras"))}
+
+
+def describe_item(item: dict, by_id: dict, by_name: dict) -> dict:
+    prod = by_id.get(item.get("pid"))
+    if prod is None:
+        return parse_item_name(item.get("n", ""), by_name)
+    variants = prod.get("variants", [])
+    v = item.get("v")
+    variant = variants[v].get("label", "") if isinstance(v, int) and 0 <= v < len(variants) else ""
+    return {"pid": prod["id"], "producto": prod["name"], "categoria": prod["category"], "variante": variant,
+            "sabor": item.get("f") or "", "extras": tuple(item.get("x") or ()),
+            "admite_extras": bool(prod.get("extras"))}
+
+
+def item_label(item: dict, lookup: tuple = None) -> str:
+    """Nombre para mostrar; si el producto ya no existe se usa la copia "n"."""
+    by_id, by_name = lookup or get_catalog_lookup()
+    if item.get("pid") not in by_id:
+        return item.get("n") or "Producto"
+    d = describe_item(item, by_id, by_name)
+    parts = [d["producto"], d["variante"], d["sabor"], *d["extras"]]
+    return ITEM_SEPARATOR.join(p for p in parts if p and p != "Único")
+
+
+def make_item(prod: dict, variant: int = None, flavor: str = None, extras: list = None,
+              price: float = 0.0, qty: int = 1) -> dict:
+    item = {"pid": prod["id"]}
+    if variant is not None:
+        item["v"] = variant
+    if flavor:
+        item["f"] = flavor
+    if extras:
+        item["x"] = list(extras)
+    item.update({"p": float(price), "q": int(qty), "added_at": now_iso()})
+    item["n"] = item_label(item)
+    return item
+
+
+def migrate_item(item: dict, lookup: tuple) -> dict:
+    """Convierte una línea antigua {"n", "p", "q"} al formato estructurado."""
+    if item.get("pid"):
+        return item
+    by_id, by_name = lookup
+    d = parse_item_name(item.get("n", ""), by_name)
+    if not d["pid"]:
+        return item
+    labels = [v.get("label") for v in by_id[d["pid"]].get("variants", [])]
+    migrated = {"pid": d["pid"]}
+    if d["variante"] in labels:
+        migrated["v"] = labels.index(d["variante"])
+    if d["sabor"]:
+        migrated["f"] = d["sabor"]
+    if d["extras"]:
+        migrated["x"] = list(d["extras"])
+    return {**item, **migrated}
+
+
+def migrate_line_items() -> dict:
+    """Reescribe las líneas antiguas de comandas cerradas y ventas. Devuelve cuántas se tocaron.
+
+    Las comandas abiertas no se tocan: reciben renglones en ese momento y su
+    venta se guarda ya migrada al cobrar. Se recorre por páginas y cada
+    página se escribe antes de pedir la siguiente.
+    """
+    lookup = get_catalog_lookup()
+    counts = {"comandas": 0, "ventas": 0}
+    for collection in ("comandas", "ventas"):
+        writes = []
+        query = db.collection(collection).order_by(firestore.FieldPath.document_id())
+        for row in iter_query(query):
+            if collection == "comandas" and row.get("estado") == "ABIERTA":
+                continue
+            items = row.get("items") or []
+            new_items = [migrate_item(x, lookup) for x in items]
+            if collection == "comandas":
+                new_items = [x if x.get("lid") else {**x, "lid": uuid.uuid4().hex[:12]} for x in new_items]
+            if new_items == items:
+                continue
+            data = {"items": new_items}
+            if collection == "comandas":
+                # Sube la versión para que las cachés de comandas se refresquen
+                data["version"] = firestore.Increment(1)
+            else:
+                data = stamped(data)  # la réplica vuelve a copiar la venta
+            writes.append(("update", db.collection(collection).document(row["id"]), data))
+            counts[collection] += 1
+            if len(writes) == REPLICA_PAGE_SIZE:
+                commit_writes(writes)
+                writes = []
+        commit_writes(writes)
+    return counts
+
+
+# ---------------------------
+# ANALÍTICA DE PRODUCTOS
+# ---------------------------
+# Las líneas de venta de la réplica se explotan a una tabla columnar. Cada
+# combinación distinta de producto/variante/sabor/extras (o nombre, en líneas
+# antiguas) se resuelve una sola vez contra el catálogo y se une a las líneas.
+@st.cache_data(ttl=60, max_entries=8)
+def load_sale_lines(where: str, params: tuple, replica_stamp: float, catalog_version) -> pd.DataFrame:
+    """Una fila por línea vendida con producto, categoría, variante, sabor y extras."""
+    lines = sales_replica().query_df(f"""
+        SELECT ventas.id AS venta, ventas.dia AS dia,
+               json_extract(j.value, '$.pid') AS pid,
+               json_extract(j.value, '$.v') AS v,
+               json_extract(j.value, '$.f') AS f,
+               json_extract(j.value, '$.x') AS x,
+               json_extract(j.value, '$.n') AS nombre,
+               COALESCE(json_extract(j.value, '$.q'), 1) AS cantidad,
+               COALESCE(json_extract(j.value, '$.p'), 0) AS precio
+        FROM ventas, json_each(ventas.items) AS j
+        WHERE {where}
+    """, params)
+    lines["importe"] = lines["precio"] * lines["cantidad"]
+    keys = ["pid", "v", "f", "x", "nombre"]
+    lines["clave"] = pd.util.hash_pandas_object(lines[keys].astype(str), index=False)
+    distinct = lines.drop_duplicates("clave")
+    by_id, by_name = get_catalog_lookup()
+    described = [
+        describe_item({
+            "pid": r.pid if isinstance(r.pid, str) else None,
+            "v": None if pd.isna(r.v) else int(r.v),
+            "f": r.f if isinstance(r.f, str) else None,
+            "x": json.loads(r.x) if isinstance(r.x, str) else None,
+            "n": r.nombre if isinstance(r.nombre, str) else "",
+        }, by_id, by_name)
+        for r in distinct.itertuples(index=False)
+    ]
+    parsed = pd.DataFrame(described, index=distinct["clave"].values,
+                          columns=["producto", "categoria", "variante", "sabor", "extras", "admite_extras"])
+    lines = lines.drop(columns=keys[:-1]).join(parsed, on="clave")
+    lines["admite_extras"] = lines["admite_extras"].fillna(False).astype(bool)
+    for col in ("producto", "categoria"):
+        lines[col] = lines[col].astype("category")
+    return lines
+
+
+def product_analytics(lines: pd.DataFrame) -> dict:
+    """Más vendidos, ventas por categoría y tasa de adjunción de adicionales."""
+    top = (lines.groupby(["producto", "categoria"], observed=True)
+           .agg(cantidad=("cantidad", "sum"), total=("importe", "sum"))
+           .sort_values("total", ascending=False).reset_index())
+
+    categories = (lines.groupby("categoria", observed=True)["importe"].sum()
+                  .sort_values(ascending=False).reset_index(name="total"))
+    categories["% ventas"] = (categories["total"] / categories["total"].sum() * 100).round(1)
+
+    # Tasa de adjunción: unidades con el adicional / unidades de productos que lo ofrecen
+    eligible = lines[lines["admite_extras"]]
+    base_units = eligible["cantidad"].sum()
+    extras = (eligible[["cantidad", "extras"]].explode("extras").dropna(subset=["extras"])
+              .groupby("extras")["cantidad"].sum().sort_values(ascending=False)
+              .reset_index(name="unidades").rename(columns={"extras": "adicional"}))
+    extras["% adjunción"] = (extras["unidades"] / base_units * 100).round(1) if base_units else 0.0
+    return {"top": top, "categories": categories, "extras": extras}
+
+
 # ---------------------------
 # DIALOG: AGREGAR PRODUCTO AL TICKET
 # ---------------------------
@@ -902,20 +2938,16 @@ def option_dialog():
     if description:
         st.caption(description)
 
-    order = load_order(doc_id)
-    items = order.get("items", [])
-
     # Variant
-    variant_labels = [v.get("label", "") for v in variants]
     if len(variants) > 1:
-        selected_var_label = st.selectbox("Tamaño / tipo", variant_labels)
-    elif variant_labels:
-        selected_var_label = variant_labels[0]
-        st.caption(f"Variante: {selected_var_label}")
+        variant_idx = st.selectbox("Tamaño / tipo", range(len(variants)), format_func=lambda i: variants[i].get("label", ""))
+    elif variants:
+        variant_idx = 0
+        st.caption(f"Variante: {variants[0].get('label', '')}")
     else:
-        selected_var_label = "Único"
+        variant_idx = None
 
-    selected_var = next((v for v in variants if v.get("label") == selected_var_label), {"label": selected_var_label, "extra": 0})
+    selected_var = variants[variant_idx] if variant_idx is not None else {"label": "Único", "extra": 0}
     running_price = infer_price_from_variant(base, selected_var)
 
     # Flavor
@@ -946,21 +2978,7 @@ def option_dialog():
 
     c1, c2 = st.columns(2)
     if c1.button("➕ Agregar", type="primary", use_container_width=True):
-        parts = [prod["name"], selected_var_label]
-        if selected_flavor:
-            parts.append(selected_flavor)
-        if selected_extras:
-            parts.extend(selected_extras)
-        item_name = " · ".join([p for p in parts if p and p != "Único"])
-
-        items.append({
-            "n": item_name,
-            "p": final_price,
-            "q": qty,
-            "added_at": now_iso(),
-        })
-        total = calc_total(items)
-        update_order(doc_id, items, total)
+        add_order_item(doc_id, make_item(prod, variant_idx, selected_flavor, selected_extras, final_price, qty))
         st.session_state.dialog_payload = None
         st.rerun()
 
@@ -972,7 +2990,7 @@ def option_dialog():
 # ---------------------------
 # ORDER HELPERS
 # ---------------------------
-def open_new_order(space_name: str, cashbox_id: str):
+def open_new_order(space_name: str, cashbox_id: str, queued: bool = False):
     payload = {
         "espacio": space_name,
         "estado": "ABIERTA",
@@ -982,12 +3000,44 @@ def open_new_order(space_name: str, cashbox_id: str):
         "fecha": now_iso(),
         "created_at": now_iso(),
         "updated_at": now_iso(),
+        "version": 1,
     }
-    _, ref = db.collection("comandas").add(payload)
+    if queued:
+        payload["numero"] = turn_allocator().next_number(now_cdmx().strftime("%Y%m%d"))
+    ref = db.collection("comandas").document()  # el id se genera localmente
+    enqueue_write("abrir_comanda", {"id": ref.id, "data": payload})
+    _cache_order(dict(payload, id=ref.id))
     st.session_state.cid = ref.id
     st.session_state.enom = space_name
 
 
+def _apply_open_order(op_id: str, payload: dict):
+    try:
+        db.collection("comandas").document(payload["id"]).create(payload["data"])
+    except gexc.AlreadyExists:
+        pass
+
+
+def cancel_order(doc_id: str):
+    """Cancela una comanda sin productos (p. ej. un pedido de la cola abierto por error)."""
+    enqueue_write("cancelar_comanda", {"cid": doc_id, "updated_at": now_iso()})
+    forget_order(doc_id)
+    close_ticket_session()
+
+
+def _apply_cancel_order(op_id: str, payload: dict):
+    def still_empty(items):
+        # Otra tableta le agregó productos mientras tanto: ya no se cancela
+        if items:
+            raise SyncConflict("La comanda ya tiene productos; no se canceló.")
+        return items
+
+    try:
+        update_order(payload["cid"], still_empty, updated_at=payload["updated_at"], extra={"estado": "CANCELADA"})
+    except OrderClosed:
+        pass  # ya se cobró o se canceló
+
+
 def add_dialog_request(prod: dict, doc_id: str):
     st.session_state.dialog_payload = {"prod": prod, "doc_id": doc_id}
     option_dialog()
@@ -997,6 +3047,686 @@ def close_ticket_session():
     st.session_state.cid = None
     st.session_state.enom = None
     st.session_state.dialog_payload = None
+    st.session_state.pending_sale = None
+
+
+# ---------------------------
+# SINCRONIZACIÓN
+# ---------------------------
+SYNC_APPLIERS = {
+    "abrir_comanda": _apply_open_order,
+    "agregar_item": _apply_add_item,
+    "quitar_item": _apply_remove_item,
+    "cantidad_item": _apply_item_qty,
+    "cobrar": _apply_checkout,
+    "cancelar_comanda": _apply_cancel_order,
+    "egreso": _apply_expense,
+}
+
+
+@st.cache_resource
+def sync_worker() -> SyncWorker:
+    worker = SyncWorker(sync_journal(), SYNC_APPLIERS, [folio_allocator().refill, turn_allocator().refill])
+    worker.start()
+    return worker
+
+
+def enqueue_write(op: str, payload: dict):
+    sync_journal().enqueue(op, payload)
+    sync_worker().wake()
+
+
+sync_worker()
+
+
+# ---------------------------
+# TICKET DE VENTA
+# ---------------------------
+# La plantilla se compila una vez al cargar el módulo y el código de barras
+# (Code 128) y el QR se generan aquí como SVG en línea: imprimir no depende de
+# ningún CDN. Con ticket_mode = "escpos" en secrets el ticket se manda en
+# crudo a la impresora térmica (escpos_printer = "host:puerto").
+TICKET_APP_URL = "https://tu-app.com"
+TICKET_WIDTH_CHARS = 42  # papel de 80 mm con fuente A
+
+# Anchos barra/espacio de los símbolos 0..106 de Code 128 (106 = stop)
+_CODE128_PATTERNS = [
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232", "2331112",
+]
+_CODE128_START_B = 104
+
+
+def code128_svg(text: str, module: float = 1.5, height: int = 42) -> str:
+    """Código de barras Code 128 (juego B) como SVG en línea."""
+    values = [ord(c) - 32 for c in text if 32 <= ord(c) < 128]
+    checksum = (_CODE128_START_B + sum(i * v for i, v in enumerate(values, 1))) % 103
+    widths = "".join(_CODE128_PATTERNS[v] for v in [_CODE128_START_B, *values, checksum, 106])
+    quiet = 10
+    x, bars = quiet, []
+    for i, w in enumerate(widths):
+        w = int(w)
+        if i % 2 == 0:
+            bars.append(f'<rect x="{x * module:g}" y="0" width="{w * module:g}" height="{height}"/>')
+        x += w
+    total = (x + quiet) * module
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{total:g}" height="{height}" '
+            f'viewBox="0 0 {total:g} {height}" fill="#000">{"".join(bars)}</svg>')
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def qr_svg(data: str) -> str:
+    img = qrcode.make(data, image_factory=qrcode.image.svg.SvgPathImage, box_size=6, border=1)
+    return img.to_string(encoding="unicode")
+
+
+TICKET_ROW_TEMPLATE = string.Template("""
+    <tr>
+        <td style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">$name</td>
+        <td align="center" style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">$qty</td>
+        <td align="right" style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">$amount</td>
+    </tr>""")
+
+TICKET_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Ticket</title>
+    <style>
+        body { margin: 0; padding: 0; background: #fff; font-family: 'Courier New', monospace; color: #000; }
+        #tkt {
+            width: 302px;
+            margin: 0 auto;
+            padding: 12px;
+            box-sizing: border-box;
+            background: #fff;
+            font-size: 12px;
+            line-height: 1.42;
+        }
+        .center { text-align: center; }
+        .small { font-size: 10px; }
+        .tiny { font-size: 9px; }
+        .title { font-size: 18px; font-weight: bold; letter-spacing: 0.8px; }
+        .subtitle { font-size: 11px; margin-top: 2px; }
+        .section { margin-top: 8px; }
+        .hr { border-top: 1px dashed #000; margin: 10px 0; }
+        table { width: 100%; border-collapse: collapse; font-size: 12px; }
+        th { text-align: left; padding-bottom: 4px; border-bottom: 1px solid #000; }
+        .bold { font-weight: bold; }
+        .total { font-size: 15px; font-weight: bold; text-align: right; margin-top: 8px; }
+        .legal { font-size: 9px; text-align: justify; margin-top: 8px; }
+        .loyalty { font-size: 10px; text-align: center; font-weight: bold; margin-top: 10px; }
+        .qr-wrap { text-align: center; margin-top: 10px; }
+        .qr-wrap svg { width: 110px; height: 110px; margin-top: 6px; }
+        .barcode-wrap { text-align: center; margin-top: 8px; }
+        .footer { text-align: center; font-size: 11px; margin-top: 8px; }
+    </style>
+</head>
+<body onload="window.print()">
+    <div id="tkt">
+        <div class="center">
+            $logo
+            <div class="title">$brand_name</div>
+            <div class="subtitle">$slogan</div>
+            <div class="small section">
+                CALZ ACOXPA 337<br>
+                COLONIA VILLA LAZARO CARDENAS
+            </div>
+            <div class="section">$fecha</div>
+            <div>Folio: $folio</div>
+            <div>Mesa: $mesa</div>
+            $numero
+            <div>Cajero(a): $cajero</div>
+        </div>
+
+        <div class="hr"></div>
+
+        <table>
+            <tr>
+                <th>Producto</th>
+                <th style="text-align:center;">Cant</th>
+                <th style="text-align:right;">Imp</th>
+            </tr>
+            $rows
+        </table>
+
+        <div class="hr"></div>
+
+        <div><span class="bold">MÉTODO DE PAGO:</span> $metodo</div>
+        $cash
+        <div class="total">TOTAL: $total</div>
+        $nota
+
+        <div class="hr"></div>
+
+        <div class="small center">
+            QUEJAS Y SUGERENCIAS:<br>
+            KIKENAPOLES02@GMAIL.COM
+        </div>
+        <div class="small center" style="margin-top:8px;">
+            FACTURAS AL CORREO:<br>
+            KIKENAPOLES02@GMAIL.COM
+        </div>
+        <div class="legal">
+            KIN HOUSE ES PROPIEDAD INDIVIDUAL REGISTRADA Y NO TIENE SUCURSALES.
+            ES UNA MARCA INDEPENDIENTE A FRANQUICIA MASTER O CHURRERIA PORFIRIO.
+        </div>
+        <div class="loyalty">
+            NO OLVIDES REGISTRAR TU MONTO EN TU TARJETA DE LEALTAD
+            PARA OBTENER RECOMPENSAS
+        </div>
+
+        <div class="qr-wrap">
+            <div class="small bold">ESCANEA Y PIDE EN LA APP</div>
+            $qr
+            <div class="tiny" style="margin-top:4px;">$app_url</div>
+        </div>
+
+        <div class="barcode-wrap">
+            $barcode
+            <div class="tiny" style="margin-top:2px;">$folio</div>
+        </div>
+
+        <div class="hr"></div>
+
+        <div class="footer">
+            ¡GRACIAS POR TU VISITA!<br>
+            VUELVE PRONTO ☀️
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+
+def build_ticket(sale: dict, cashier: str) -> dict:
+    """Datos del ticket a partir del documento de venta."""
+    return {
+        "folio": sale["folio"],
+        "fecha": datetime.fromisoformat(sale["fecha"]).astimezone(CDMX_TZ).strftime("%d/%m/%Y %H:%M"),
+        "mesa": sale.get("mesa", ""),
+        "numero": sale.get("numero"),
+        "cajero": cashier or "N/A",
+        "lines": [(item_label(x), int(x.get("q", 1)), line_amount(x)) for x in sale.get("items", [])],
+        "metodo": sale.get("metodo", ""),
+        "recibido": sale.get("recibido"),
+        "cambio": sale.get("cambio"),
+        "total": float(sale.get("total", 0)),
+        "nota": sale.get("nota") or "",
+    }
+
+
+def render_ticket_html(ticket: dict) -> str:
+    esc = html.escape
+    logo = logo_src(brand, TICKET_LOGO_PX)
+    cash = ""
+    if ticket["recibido"] is not None:
+        cash = (f"<div style='margin-top:6px;'><b>RECIBIDO:</b> {money(ticket['recibido'])}</div>"
+                f"<div><b>CAMBIO:</b> {money(ticket['cambio'])}</div>")
+    return TICKET_TEMPLATE.substitute(
+        logo=f'<img src="{logo}" width="82" style="margin-bottom:6px;"><br>' if logo else "",
+        brand_name=esc(brand.get("nombre", "KIN House")),
+        slogan=esc(brand.get("slogan", "")),
+        fecha=ticket["fecha"],
+        folio=esc(ticket["folio"]),
+        mesa=esc(ticket["mesa"]),
+        numero=f'<div class="title">PEDIDO #{ticket["numero"]:03d}</div>' if ticket["numero"] else "",
+        cajero=esc(ticket["cajero"]),
+        rows="".join(TICKET_ROW_TEMPLATE.substitute(name=esc(name), qty=qty, amount=money(amount))
+                     for name, qty, amount in ticket["lines"]),
+        metodo=esc(ticket["metodo"]),
+        cash=cash,
+        total=money(ticket["total"]),
+        nota=f'<div style="margin-top:8px;"><span class="bold">NOTA:</span> {esc(ticket["nota"])}</div>' if ticket["nota"] else "",
+        qr=qr_svg(TICKET_APP_URL),
+        app_url=TICKET_APP_URL,
+        barcode=code128_svg(ticket["folio"]),
+    )
+
+
+# Comandos ESC/POS
+_ESC_INIT = b"\x1b@"
+_ESC_CENTER, _ESC_LEFT = b"\x1ba\x01", b"\x1ba\x00"
+_ESC_BOLD_ON, _ESC_BOLD_OFF = b"\x1bE\x01", b"\x1bE\x00"
+_ESC_DOUBLE, _ESC_NORMAL = b"\x1d!\x11", b"\x1d!\x00"
+_ESC_CUT = b"\x1dV\x42\x00"
+
+
+def _escpos_text(text: str) -> bytes:
+    return (text + "\n").encode("cp858", errors="replace")
+
+
+def _escpos_qr(data: str) -> bytes:
+    payload = data.encode("ascii", errors="replace")
+    size = len(payload) + 3
+    return (b"\x1d(k\x04\x001A2\x00"            # modelo 2
+            + b"\x1d(k\x03\x001C\x06"           # tamaño de módulo
+            + b"\x1d(k\x03\x001E\x31"           # corrección M
+            + b"\x1d(k" + bytes([size % 256, size // 256]) + b"1P0" + payload
+            + b"\x1d(k\x03\x001Q0")             # imprimir
+
+
+def _escpos_code128(text: str) -> bytes:
+    data = b"{B" + text.encode("ascii", errors="replace")
+    return b"\x1dh\x40" + b"\x1dw\x02" + b"\x1dH\x00" + b"\x1dk\x49" + bytes([len(data)]) + data
+
+
+def render_ticket_escpos(ticket: dict, width: int = TICKET_WIDTH_CHARS) -> bytes:
+    def row(left: str, right: str) -> bytes:
+        return _escpos_text(f"{left[:width - len(right) - 1]:<{width - len(right)}}{right}")
+
+    out = [_ESC_INIT, _ESC_CENTER, _ESC_DOUBLE, _escpos_text(brand.get("nombre", "KIN House")), _ESC_NORMAL]
+    if brand.get("slogan"):
+        out.append(_escpos_text(brand["slogan"]))
+    out += [
+        _escpos_text("CALZ ACOXPA 337"), _escpos_text("COLONIA VILLA LAZARO CARDENAS"),
+        _escpos_text(ticket["fecha"]), _escpos_text(f"Folio: {ticket['folio']}"),
+        _escpos_text(f"Mesa: {ticket['mesa']}"), _escpos_text(f"Cajero(a): {ticket['cajero']}"),
+    ]
+    if ticket["numero"]:
+        out += [_ESC_DOUBLE, _escpos_text(f"PEDIDO #{ticket['numero']:03d}"), _ESC_NORMAL]
+    out += [_ESC_LEFT, _escpos_text("-" * width)]
+    for name, qty, amount in ticket["lines"]:
+        out.append(row(f"{qty} x {name}", money(amount)))
+    out += [_escpos_text("-" * width), row("METODO DE PAGO:", ticket["metodo"])]
+    if ticket["recibido"] is not None:
+        out += [row("RECIBIDO:", money(ticket["recibido"])), row("CAMBIO:", money(ticket["cambio"]))]
+    out += [_ESC_BOLD_ON, row("TOTAL:", money(ticket["total"])), _ESC_BOLD_OFF]
+    if ticket["nota"]:
+        out.append(_escpos_text(f"NOTA: {ticket['nota']}"))
+    out += [
+        _escpos_text("-" * width), _ESC_CENTER,
+        _escpos_text("QUEJAS, SUGERENCIAS Y FACTURAS:"), _escpos_text("KIKENAPOLES02@GMAIL.COM"),
+        _escpos_text("ESCANEA Y PIDE EN LA APP"), _escpos_qr(TICKET_APP_URL),
+        _escpos_code128(ticket["folio"]),
+        _escpos_text("¡GRACIAS POR TU VISITA!"), _escpos_text("VUELVE PRONTO"),
+        b"\n\n\n", _ESC_CUT,
+    ]
+    return b"".join(out)
+
+
+def send_escpos(data: bytes, target: str, timeout: float = 5):
+    """Envía bytes en crudo a una impresora de red (puerto 9100 por omisión)."""
+    host, _, port = target.partition(":")
+    with socket.create_connection((host, int(port or 9100)), timeout=timeout) as conn:
+        conn.sendall(data)
+
+
+def print_ticket(ticket: dict):
+    if st.secrets.get("ticket_mode", "html") == "escpos":
+        data = render_ticket_escpos(ticket)
+        printer = st.secrets.get("escpos_printer", "")
+        try:
+            if not printer:
+                raise OSError("escpos_printer no está configurada")
+            send_escpos(data, printer)
+            return
+        except OSError as e:
+            st.warning(f"No se pudo enviar a la impresora: {e}")
+            st.download_button("⬇️ Descargar ticket ESC/POS", data=data,
+                               file_name=f"{ticket['folio']}.bin", mime="application/octet-stream")
+            return
+    components.html(render_ticket_html(ticket), height=650, scrolling=True)
+
+
+# ---------------------------
+# MESAS — REGIONES INDEPENDIENTES
+# ---------------------------
+# Cada región es un st.fragment: sus widgets solo vuelven a ejecutar la
+# región. Cambiar de comanda, agregar desde el diálogo o cobrar sí
+# re-ejecutan la página completa (st.rerun() sin scope).
+def _same_order(doc_id: str):
+    # Otra región cambió la comanda activa; se redibuja la página completa
+    if st.session_state.cid != doc_id:
+        st.rerun()
+
+
+# Se redibuja sola, como el KDS: lee del listener de comandas abiertas, así
+# que las mesas que abre o cobra otra tableta aparecen sin tocar nada.
+@st.fragment(run_every=2)
+def tables_grid(cashbox: dict):
+    spaces = get_spaces()
+    if not spaces:
+        st.info("No hay espacios activos. Agrégalos en ⚙️ Config.")
+        return
+    open_orders = get_open_orders_by_space()
+
+    zones = list(dict.fromkeys(s.get("zona") or "General" for s in spaces))
+    zone = zones[0]
+    if len(zones) > 1:
+        zone = st.radio("Zona", zones, horizontal=True, key="space_zone", label_visibility="collapsed")
+    in_zone = [s for s in spaces if (s.get("zona") or "General") == zone]
+
+    n_pages = max(1, -(-len(in_zone) // SPACES_PER_PAGE))
+    page_key = f"space_page_{zone}"
+    page = min(st.session_state.get(page_key, 0), n_pages - 1)
+
+    cols = st.columns(4)
+    for i, space in enumerate(in_zone[page * SPACES_PER_PAGE:(page + 1) * SPACES_PER_PAGE]):
+        name = space["nombre"]
+        orders = open_orders.get(name, [])
+        with cols[i % 4]:
+            bg = "#C0392B" if orders else "#3A7D44"
+            if space.get("cola"):
+                badge = f"🥡 {len(orders)} EN COLA" if orders else "○ SIN PEDIDOS"
+            else:
+                badge = "○ LIBRE" if not orders else "● OCUPADO" if len(orders) == 1 else f"● {len(orders)} ABIERTAS"
+            st.markdown(
+                f'<div class="mesa-card" style="background:{bg};">'
+                f'<div style="font-size:11px;opacity:0.75;letter-spacing:1px;">{badge}</div>'
+                f'<div style="font-size:15px;margin-top:4px;">{name}</div>'
+                f'</div>',
+                unsafe_allow_html=True
+            )
+            if space.get("cola"):
+                # Los pedidos abiertos se eligen desde el panel de la cola
+                if st.button("➕ Nuevo pedido", key=f"space_{space['id']}"):
+                    open_new_order(name, cashbox["id"], queued=True)
+                    st.rerun()
+                continue
+            if not orders:
+                if st.button("Abrir / Ver", key=f"space_{space['id']}"):
+                    open_new_order(name, cashbox["id"])
+                    st.rerun()
+            for n, order_id in enumerate(orders):
+                if st.button("Abrir / Ver" if len(orders) == 1 else f"Ver #{n + 1}", key=f"ord_{order_id}"):
+                    st.session_state.cid = order_id
+                    st.session_state.enom = name
+                    st.rerun()
+
+    if n_pages > 1:
+        p1, p2, p3 = st.columns([1, 2, 1])
+        if p1.button("◀", key=f"{page_key}_prev", disabled=page == 0):
+            st.session_state[page_key] = page - 1
+            st.rerun(scope="fragment")
+        p2.caption(f"Página {page + 1} de {n_pages}")
+        if p3.button("▶", key=f"{page_key}_next", disabled=page >= n_pages - 1):
+            st.session_state[page_key] = page + 1
+            st.rerun(scope="fragment")
+
+    queue_names = [s["nombre"] for s in spaces if s.get("cola")]
+    if queue_names:
+        st.markdown("**🥡 Cola de pedidos**")
+        queue = get_order_queue(queue_names)
+        if not queue:
+            st.caption("Sin pedidos en cola.")
+        for row in queue:
+            q1, q2, q3 = st.columns([3, 1, 1])
+            opened = row.get("created_at", "")[11:16]
+            q1.markdown(f"**{order_number(row)}** · {row.get('espacio', '')} · {opened}")
+            q2.markdown(money(calc_total(row.get("items", []))))
+            if q3.button("Ver", key=f"queue_{row['id']}"):
+                st.session_state.cid = row["id"]
+                st.session_state.enom = row.get("espacio", "")
+                st.rerun()
+
+
+@st.fragment
+def menu_panel(doc_id: str):
+    # Solo se dibujan los botones de la categoría seleccionada.
+    _same_order(doc_id)
+    catalog_index = get_catalog_index()
+    tab_name = st.radio("Categoría", list(catalog_index["tabs"].keys()), horizontal=True,
+                        key="menu_tab", label_visibility="collapsed")
+    for section_name, pids in catalog_index["tabs"].get(tab_name, []):
+        st.markdown(f'<span class="section-pill">{section_name}</span>', unsafe_allow_html=True)
+        chunk = 3
+        for start in range(0, len(pids), chunk):
+            row = pids[start:start + chunk]
+            rcols = st.columns(len(row))
+            for j, pid in enumerate(row):
+                prod = catalog_index["products"][pid]
+                label = f"{prod['name']}\n{money(prod['base'])}"
+                if rcols[j].button(label, key=f"p_{pid}"):
+                    add_dialog_request(prod, doc_id)
+
+
+@st.fragment
+def ticket_panel(doc_id: str, space_name: str, cashbox: dict):
+    _same_order(doc_id)
+    order = load_order(doc_id)
+    order_items = order.get("items", [])
+    order_total = calc_total(order_items)
+
+    st.markdown('<div class="ticket-box">', unsafe_allow_html=True)
+    st.markdown("### 🧾 Ticket")
+
+    if not order_items:
+        st.info("Aún no hay productos.")
+    else:
+        for idx, item in enumerate(order_items):
+            left, mid, minus, plus, right = st.columns([3.2, 1.5, 0.6, 0.6, 0.6])
+            left.markdown(f'<div class="item-name">{item_label(item)}</div>', unsafe_allow_html=True)
+            qty = int(item.get("q", 1))
+            unit_p = float(item.get("p", 0))
+            mid.markdown(f'<div class="item-price">x{qty} · {money(unit_p * qty)}</div>', unsafe_allow_html=True)
+            key, no_lid = item.get("lid", idx), not item.get("lid")
+            if minus.button("−", key=f"qm_{key}", disabled=no_lid or qty <= 1):
+                set_order_item_qty(doc_id, item, qty - 1)
+                st.rerun(scope="fragment")
+            if plus.button("+", key=f"qp_{key}", disabled=no_lid):
+                set_order_item_qty(doc_id, item, qty + 1)
+                st.rerun(scope="fragment")
+            if right.button("✕", key=f"rm_{key}", disabled=no_lid):
+                remove_order_item(doc_id, item)
+                st.rerun(scope="fragment")
+
+        st.divider()
+
+    st.subheader(f"Total: {money(order_total)}")
+    if order.get("incompleta"):
+        # Hay renglones en cola pero no una copia local de la comanda: cobrar
+        # ahora podría quedarse corto.
+        st.warning("Esta comanda tiene cambios sin sincronizar. Podrás cobrar al recuperar la conexión.")
+    else:
+        payment_panel(doc_id, space_name, cashbox, order_items, order_total, order.get("numero"))
+
+    if st.button("↩ Salir sin cerrar"):
+        close_ticket_session()
+        st.rerun()
+    if not order_items and not order.get("incompleta"):
+        # Una comanda vacía no se puede cobrar: sin esto quedaría abierta
+        # para siempre en la cuadrícula o en la cola.
+        if st.button("🗑️ Cancelar comanda"):
+            cancel_order(doc_id)
+            st.rerun()
+
+    st.markdown("</div>", unsafe_allow_html=True)
+
+
+@st.fragment
+def payment_panel(doc_id: str, space_name: str, cashbox: dict, order_items: list, order_total: float,
+                  numero: int = None):
+    # Recibe la comanda ya cargada: escribir "Recibido $" no lee nada de Firestore
+    _same_order(doc_id)
+    payment_method = st.selectbox("Pago", ["Efectivo", "Tarjeta", "Transferencia"])
+    cash_received = 0.0
+    if payment_method == "Efectivo":
+        cash_received = st.number_input("Recibido $", min_value=0.0, step=10.0)
+        change = max(cash_received - order_total, 0)
+        st.caption(f"💰 Cambio: **{money(change)}**")
+
+    can_charge = order_total > 0 and (payment_method != "Efectivo" or cash_received >= order_total)
+    sale_note = st.text_input("Nota (opcional)")
+
+    if st.button("✅ COBRAR", type="primary", disabled=not can_charge):
+        try:
+            folio = pending_sale_folio(doc_id)
+        except sqlite3.Error as e:
+            st.error(f"No fue posible asignar el folio, intenta de nuevo: {e}")
+            st.stop()
+        lookup = get_catalog_lookup()
+        sale_doc = {
+            "folio": folio,
+            "total": order_total,
+            "metodo": payment_method,
+            "mesa": space_name,
+            **time_buckets(),
+            "caja_id": cashbox["id"],
+            # Las líneas antiguas se migran al cobrar (la migración masiva
+            # deja fuera las comandas abiertas)
+            "items": [migrate_item(x, lookup) for x in order_items],
+            "nota": sale_note,
+            "recibido": cash_received if payment_method == "Efectivo" else None,
+            "cambio": (cash_received - order_total) if payment_method == "Efectivo" else None,
+            "comanda_id": doc_id,
+        }
+        if numero:
+            sale_doc["numero"] = numero
+        try:
+            checkout_order(doc_id, cashbox["id"], sale_doc)
+        except sqlite3.Error as e:
+            st.error(f"No fue posible registrar la venta, intenta de nuevo: {e}")
+            st.stop()
+
+        # El ticket se imprime en la siguiente ejecución completa, que ya
+        # muestra el espacio libre en la cuadrícula.
+        st.session_state.last_ticket = build_ticket(sale_doc, cashbox.get("usuario", "N/A"))
+        forget_order(doc_id)
+        close_ticket_session()
+        st.rerun()
+
+
+
+# ---------------------------
+# COCINA (KDS)
+# ---------------------------
+# El tablero une dos listeners: las comandas abiertas (aunque se hayan
+# abierto antes de medianoche) y las tocadas hoy (las ya cobradas siguen
+# hasta que cocina las marque); la página se refresca cada segundo leyendo
+# solo memoria. Cada renglón va a una estación
+# según la categoría de su producto y se marca listo en comandas.cocina.<lid>.
+KITCHEN_STATIONS = {"☕ Bebidas": "Bebidas"}  # categoría -> estación
+KITCHEN_DEFAULT_STATION = "Cocina"
+
+
+def kitchen_day_start() -> str:
+    return now_cdmx().replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+
+
+@st.cache_resource
+def _kitchen_watch() -> dict:
+    # Un solo listener de "tocadas hoy" por proceso. Al cambiar el día (o si
+    # se cae) se cierra el anterior antes de abrir el nuevo: desalojarlo de
+    # una caché no lo cerraría y seguiría recibiendo cambios.
+    return {"day": None, "live": None, "lock": threading.Lock()}
+
+
+def _kitchen_live(day_start: str) -> LiveQuery:
+    watch = _kitchen_watch()
+    with watch["lock"]:
+        live = watch["live"]
+        if live is None or watch["day"] != day_start or not live.alive():
+            if live is not None:
+                live.close()
+            watch["live"] = None
+            watch["live"] = LiveQuery(db.collection("comandas").where("updated_at", ">=", day_start))
+            watch["day"] = day_start
+        return watch["live"]
+
+
+@st.cache_resource
+def _kitchen_board_cache() -> dict:
+    return {"key": None, "board": {}}
+
+
+def _iso_timestamp(*values) -> float:
+    # added_at/created_at pueden venir vacíos o mal formados en comandas antiguas
+    for value in values:
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return time.time()
+
+
+def _build_kitchen_board(docs: dict, lookup: tuple) -> dict:
+    board = {}
+    for doc_id, row in docs.items():
+        done = row.get("cocina") or {}
+        by_station = {}
+        for item in row.get("items", []):
+            if not item.get("lid") or item["lid"] in done:
+                continue
+            station = KITCHEN_STATIONS.get(describe_item(item, *lookup)["categoria"], KITCHEN_DEFAULT_STATION)
+            by_station.setdefault(station, []).append(item)
+        for station, items in by_station.items():
+            items.sort(key=lambda x: str(x.get("added_at") or ""))
+            board.setdefault(station, []).append({
+                "id": doc_id,
+                "espacio": row.get("espacio", ""),
+                "numero": row.get("numero"),
+                "items": items,
+                "desde": _iso_timestamp(items[0].get("added_at"), row.get("created_at")),
+            })
+    for orders in board.values():
+        orders.sort(key=lambda o: o["desde"])
+    return board
+
+
+def kitchen_board():
+    """{estación: [pedidos con renglones pendientes, el más antiguo primero]} o None sin listener."""
+    day_start = kitchen_day_start()
+    try:
+        today = _kitchen_live(day_start).snapshot()
+    except Exception:
+        today = None
+    open_orders = live_snapshot(_open_orders_live)
+    if today is None or open_orders is None:
+        return None
+    docs = {**today[1], **open_orders[1]}
+    # Se recalcula solo con un snapshot nuevo o un cambio de catálogo
+    key = (day_start, today[0], open_orders[0], get_catalog_version())
+    cache = _kitchen_board_cache()
+    if cache["key"] != key:
+        cache["board"], cache["key"] = _build_kitchen_board(docs, get_catalog_lookup()), key
+    return cache["board"]
+
+
+def bump_kitchen_items(doc_id: str, lids: list):
+    done = {"estado": "listo", "at": now_iso()}
+    db.collection("comandas").document(doc_id).update(
+        {firestore.FieldPath("cocina", lid).to_api_repr(): done for lid in lids}
+    )
+
+
+@st.fragment(run_every=1)
+def kitchen_view(station: str):
+    board = kitchen_board()
+    if board is None:
+        st.warning("Sin conexión con Firestore; reintentando...")
+        return
+    orders = board.get(station, [])
+    if not orders:
+        st.info("Sin pendientes 🎉")
+        return
+
+    now_ts = time.time()
+    cols = st.columns(3)
+    for i, order in enumerate(orders):
+        with cols[i % 3]:
+            minutes = int((now_ts - order["desde"]) // 60)
+            number = f" · {order_number(order)}" if order.get("numero") else ""
+            st.markdown(f"**{order['espacio']}**{number} · ⏱ {minutes} min")
+            for item in order["items"]:
+                left, right = st.columns([4, 1])
+                left.markdown(f"{int(item.get('q', 1))}× {item_label(item)}")
+                if right.button("✔", key=f"kds_{order['id']}_{item['lid']}"):
+                    bump_kitchen_items(order["id"], [item["lid"]])
+                    st.rerun(scope="fragment")
+            if st.button("✅ Todo listo", key=f"kds_all_{order['id']}_{station}"):
+                bump_kitchen_items(order["id"], [x["lid"] for x in order["items"]])
+                st.rerun(scope="fragment")
+            st.divider()
 
 
 # ---------------------------
@@ -1004,18 +3734,31 @@ def close_ticket_session():
 # ---------------------------
 with st.sidebar:
     if brand.get("logo_url"):
-        st.markdown(f'<div class="sidebar-logo"><img src="{brand["logo_url"]}" style="width:80px;border-radius:12px;margin-bottom:10px;"></div>', unsafe_allow_html=True)
+        st.markdown(f'<div class="sidebar-logo"><img src="{logo_src(brand, SIDEBAR_LOGO_PX)}" style="width:80px;border-radius:12px;margin-bottom:10px;"></div>', unsafe_allow_html=True)
 
     st.markdown(f'<div class="sidebar-logo"><div class="brand-name">{brand.get("nombre","KIN House")}</div><div class="brand-slogan">{brand.get("slogan","Mismo sabor, mismo lugar")}</div></div>', unsafe_allow_html=True)
 
     st.markdown("---")
-    menu_nav = st.selectbox("NAVEGACIÓN", ["🪑 Mesas", "💵 Caja", "📊 Reporte", "🛒 Catálogo", "⚙️ Config"])
+    menu_nav = st.selectbox("NAVEGACIÓN", ["🪑 Mesas", "👨‍🍳 Cocina", "💵 Caja", "📊 Reporte", "🛒 Catálogo", "⚙️ Config"])
     st.markdown("---")
     admin_pin = st.text_input("PIN Admin", type="password")
     is_admin = admin_pin == get_admin_pin()
     if is_admin:
         st.success("✓ Admin activo")
 
+    sync_counts = sync_journal().counts()
+    if sync_counts.get("pendiente"):
+        st.caption(f"⏳ {sync_counts['pendiente']} cambio(s) por sincronizar")
+    set_aside = sync_counts.get("conflicto", 0) + sync_counts.get("fallida", 0)
+    if set_aside:
+        # Un cobro apartado es una venta que aún no llega a Firestore: se
+        # avisa aparte para que no se confunda con un renglón rechazado.
+        unsynced_sales = sum(1 for c in sync_journal().conflicts() if c["op"] == "cobrar")
+        if unsynced_sales:
+            st.error(f"⚠️ {unsynced_sales} cobro(s) sin registrar en Firestore · revisa en Config")
+        if set_aside > unsynced_sales:
+            st.warning(f"⚠️ {set_aside - unsynced_sales} cambio(s) con conflicto o fallidos · revisa en Config")
+
 
 # ============================================================
 # VIEW: MESAS
@@ -1028,341 +3771,33 @@ if menu_nav == "🪑 Mesas":
         st.error("🛑 No hay caja abierta. Ve a **Caja** para abrir turno.")
         st.stop()
 
-    spaces = ["Mesa 1", "Mesa 2", "Mesa 3", "Mesa 4", "Sillón 1", "Sillón 2", "Barra", "Llevar"]
-    open_orders = get_open_orders_by_space()
+    if st.session_state.last_ticket:
+        ticket = st.session_state.last_ticket
+        st.session_state.last_ticket = None
+        st.success(f"✅ Venta registrada: {ticket['folio']}")
+        print_ticket(ticket)
 
-    cols = st.columns(4)
-    for i, space in enumerate(spaces):
-        with cols[i % 4]:
-            occupied = space in open_orders
-            bg = "#C0392B" if occupied else "#3A7D44"
-            badge = "● OCUPADO" if occupied else "○ LIBRE"
-            st.markdown(
-                f'<div class="mesa-card" style="background:{bg};">'
-                f'<div style="font-size:11px;opacity:0.75;letter-spacing:1px;">{badge}</div>'
-                f'<div style="font-size:15px;margin-top:4px;">{space}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-            if st.button("Abrir / Ver", key=f"space_{space}"):
-                if occupied:
-                    st.session_state.cid = open_orders[space]
-                    st.session_state.enom = space
-                else:
-                    open_new_order(space, cashbox["id"])
-                st.rerun()
+    tables_grid(cashbox)
 
     if st.session_state.cid:
-        order = load_order(st.session_state.cid)
-        order_items = order.get("items", [])
-        order_total = calc_total(order_items)
-
         st.divider()
         st.subheader(f"📍 {st.session_state.enom}")
 
-        catalog = get_catalog()
         col_menu, col_ticket = st.columns([2.3, 1])
-
         with col_menu:
-            tabs = st.tabs(list(catalog.keys()))
-            for tab_index, tab_name in enumerate(catalog.keys()):
-                with tabs[tab_index]:
-                    sections = catalog[tab_name]
-                    for section_name, products in sections.items():
-                        st.markdown(f'<span class="section-pill">{section_name}</span>', unsafe_allow_html=True)
-                        chunk = 3
-                        for start in range(0, len(products), chunk):
-                            row = products[start:start + chunk]
-                            rcols = st.columns(len(row))
-                            for j, prod in enumerate(row):
-                                label = f"{prod['name']}\n{money(prod['base'])}"
-                                if rcols[j].button(label, key=f"p_{tab_name}_{section_name}_{prod['name']}_{start+j}"):
-                                    add_dialog_request(prod, st.session_state.cid)
-
+            menu_panel(st.session_state.cid)
         with col_ticket:
-            st.markdown('<div class="ticket-box">', unsafe_allow_html=True)
-            st.markdown("### 🧾 Ticket")
+            ticket_panel(st.session_state.cid, st.session_state.enom, cashbox)
 
-            if not order_items:
-                st.info("Aún no hay productos.")
-            else:
-                for idx, item in enumerate(order_items):
-                    left, mid, right = st.columns([4, 1.5, 1])
-                    left.markdown(f'<div class="item-name">{item.get("n","Producto")}</div>', unsafe_allow_html=True)
-                    qty = int(item.get("q", 1))
-                    unit_p = float(item.get("p", 0))
-                    mid.markdown(f'<div class="item-price">x{qty} · {money(unit_p * qty)}</div>', unsafe_allow_html=True)
-                    if right.button("✕", key=f"rm_{idx}"):
-                        order_items.pop(idx)
-                        update_order(st.session_state.cid, order_items, calc_total(order_items))
-                        st.rerun()
-
-                st.divider()
-
-            st.subheader(f"Total: {money(order_total)}")
-
-            payment_method = st.selectbox("Pago", ["Efectivo", "Tarjeta", "Transferencia"])
-            cash_received = 0.0
-            if payment_method == "Efectivo":
-                cash_received = st.number_input("Recibido $", min_value=0.0, step=10.0)
-                change = max(cash_received - order_total, 0)
-                st.caption(f"💰 Cambio: **{money(change)}**")
-
-            can_charge = order_total > 0 and (payment_method != "Efectivo" or cash_received >= order_total)
-            sale_note = st.text_input("Nota (opcional)")
-
-            if st.button("✅ COBRAR", type="primary", disabled=not can_charge):
-                folio = build_sale_folio()
-                sale_doc = {
-                    "folio": folio,
-                    "total": order_total,
-                    "metodo": payment_method,
-                    "mesa": st.session_state.enom,
-                    "fecha": now_iso(),
-                    "caja_id": cashbox["id"],
-                    "items": order_items,
-                    "nota": sale_note,
-                    "recibido": cash_received if payment_method == "Efectivo" else None,
-                    "cambio": (cash_received - order_total) if payment_method == "Efectivo" else None,
-                }
-                db.collection("ventas").add(sale_doc)
-
-                logo_src = brand.get("logo_url", "")
-                items_html = "".join([
-                    f"<tr><td>{x.get('n','')}</td><td align='center'>{x.get('q',1)}</td><td align='right'>${float(x.get('p',0))*int(x.get('q',1)):,.0f}</td></tr>"
-                    for x in order_items
-                ])
-                recibido_html = f"<div>RECIBIDO: {money(cash_received)}</div><div>CAMBIO: {money(cash_received - order_total)}</div>" if payment_method == "Efectivo" else ""
-
-                app_url = "https://tu-app.com"
-                cajero_ticket = cashbox.get("usuario", "N/A")
-                
-                items_html = "".join([
-                    f"""
-                    <tr>
-                        <td style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">{x.get('n','')}</td>
-                        <td align="center" style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">{x.get('q',1)}</td>
-                        <td align="right" style="padding:4px 0;vertical-align:top;border-bottom:1px dotted #ddd;">${float(x.get('p',0))*int(x.get('q',1)):,.0f}</td>
-                    </tr>
-                    """
-                    for x in order_items
-                ])
-                
-                recibido_html = (
-                    f"<div style='margin-top:6px;'><b>RECIBIDO:</b> {money(cash_received)}</div>"
-                    f"<div><b>CAMBIO:</b> {money(cash_received - order_total)}</div>"
-                ) if payment_method == "Efectivo" else ""
-                
-                
-                ticket_html = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <meta charset="UTF-8">
-                    <title>Ticket</title>
-                    <script src="https://cdn.jsdelivr.net/npm/jsbarcode@3.11.6/dist/JsBarcode.all.min.js"></script>
-                    <style>
-                        body {{
-                            margin: 0;
-                            padding: 0;
-                            background: #fff;
-                            font-family: 'Courier New', monospace;
-                            color: #000;
-                        }}
-                
-                        #tkt {{
-                            width: 302px;
-                            margin: 0 auto;
-                            padding: 12px;
-                            box-sizing: border-box;
-                            background: #fff;
-                            font-size: 12px;
-                            line-height: 1.42;
-                        }}
-                
-                        .center {{ text-align: center; }}
-                        .small {{ font-size: 10px; }}
-                        .tiny {{ font-size: 9px; }}
-                        .title {{
-                            font-size: 18px;
-                            font-weight: bold;
-                            letter-spacing: 0.8px;
-                        }}
-                        .subtitle {{
-                            font-size: 11px;
-                            margin-top: 2px;
-                        }}
-                        .section {{
-                            margin-top: 8px;
-                        }}
-                        .hr {{
-                            border-top: 1px dashed #000;
-                            margin: 10px 0;
-                        }}
-                        table {{
-                            width: 100%;
-                            border-collapse: collapse;
-                            font-size: 12px;
-                        }}
-                        th {{
-                            text-align: left;
-                            padding-bottom: 4px;
-                            border-bottom: 1px solid #000;
-                        }}
-                        .right {{ text-align: right; }}
-                        .bold {{ font-weight: bold; }}
-                        .total {{
-                            font-size: 15px;
-                            font-weight: bold;
-                            text-align: right;
-                            margin-top: 8px;
-                        }}
-                        .legal {{
-                            font-size: 9px;
-                            text-align: justify;
-                            margin-top: 8px;
-                        }}
-                        .loyalty {{
-                            font-size: 10px;
-                            text-align: center;
-                            font-weight: bold;
-                            margin-top: 10px;
-                        }}
-                        .qr-wrap {{
-                            text-align: center;
-                            margin-top: 10px;
-                        }}
-                        .barcode-wrap {{
-                            text-align: center;
-                            margin-top: 8px;
-                        }}
-                        .footer {{
-                            text-align: center;
-                            font-size: 11px;
-                            margin-top: 8px;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div id="tkt">
-                        <div class="center">
-                            {f'<img src="{logo_src}" width="82" style="margin-bottom:6px;"><br>' if logo_src else ''}
-                            <div class="title">{brand.get('nombre','KIN House')}</div>
-                            <div class="subtitle">{brand.get('slogan','')}</div>
-                
-                            <div class="small section">
-                                CALZ ACOXPA 337<br>
-                                COLONIA VILLA LAZARO CARDENAS
-                            </div>
-                
-                            <div class="section">
-                                {now_cdmx().strftime('%d/%m/%Y %H:%M')}
-                            </div>
-                            <div>Folio: {folio}</div>
-                            <div>Mesa: {st.session_state.enom}</div>
-                            <div>Cajero(a): {cajero_ticket}</div>
-                        </div>
-                
-                        <div class="hr"></div>
-                
-                        <table>
-                            <tr>
-                                <th>Producto</th>
-                                <th style="text-align:center;">Cant</th>
-                                <th style="text-align:right;">Imp</th>
-                            </tr>
-                            {items_html}
-                        </table>
-                
-                        <div class="hr"></div>
-                
-                        <div><span class="bold">MÉTODO DE PAGO:</span> {payment_method}</div>
-                        {recibido_html}
-                
-                        <div class="total">TOTAL: {money(order_total)}</div>
-                
-                        {f'<div style="margin-top:8px;"><span class="bold">NOTA:</span> {sale_note}</div>' if sale_note else ''}
-                
-                        <div class="hr"></div>
-                
-                        <div class="small center">
-                            QUEJAS Y SUGERENCIAS:<br>
-                            KIKENAPOLES02@GMAIL.COM
-                        </div>
-                
-                        <div class="small center" style="margin-top:8px;">
-                            FACTURAS AL CORREO:<br>
-                            KIKENAPOLES02@GMAIL.COM
-                        </div>
-                
-                        <div class="legal">
-                            KIN HOUSE ES PROPIEDAD INDIVIDUAL REGISTRADA Y NO TIENE SUCURSALES.
-                            ES UNA MARCA INDEPENDIENTE A FRANQUICIA MASTER O CHURRERIA PORFIRIO.
-                        </div>
-                
-                        <div class="loyalty">
-                            NO OLVIDES REGISTRAR TU MONTO EN TU TARJETA DE LEALTAD
-                            PARA OBTENER RECOMPENSAS
-                        </div>
-                
-                        <div class="qr-wrap">
-                            <div class="small bold">ESCANEA Y PIDE EN LA APP</div>
-                            <img
-                                src="https://api.qrserver.com/v1/create-qr-code/?size=110x110&data={app_url}"
-                                width="110"
-                                height="110"
-                                alt="QR APP"
-                                style="margin-top:6px;"
-                            >
-                            <div class="tiny" style="margin-top:4px;">{app_url}</div>
-                        </div>
-                
-                        <div class="barcode-wrap">
-                            <svg id="barcode"></svg>
-                            <div class="tiny" style="margin-top:2px;">{folio}</div>
-                        </div>
-                
-                        <div class="hr"></div>
-                
-                        <div class="footer">
-                            ¡GRACIAS POR TU VISITA!<br>
-                            VUELVE PRONTO ☀️
-                        </div>
-                    </div>
-                
-                    <script>
-                        JsBarcode("#barcode", "{folio}", {{
-                            format: "CODE128",
-                            lineColor: "#000",
-                            width: 1.5,
-                            height: 42,
-                            displayValue: false,
-                            margin: 0
-                        }});
-                
-                        setTimeout(function() {{
-                            window.print();
-                        }}, 500);
-                    </script>
-                </body>
-                </html>
-                """
-                components.html(ticket_html, height=650, scrolling=True)
-                st.success(f"✅ Venta registrada: {folio}")
-                
-                db.collection("comandas").document(st.session_state.cid).update({
-                    "estado": "CERRADA",
-                    "closed_at": now_iso(),
-                    "venta_folio": folio,
-                    "total": order_total,
-                })
-                close_ticket_session()
-
-            if st.button("↩ Salir sin cerrar"):
-                close_ticket_session()
-                st.rerun()
 
-            st.markdown("</div>", unsafe_allow_html=True)
+# ============================================================
+# VIEW: COCINA
+# ============================================================
+elif menu_nav == "👨‍🍳 Cocina":
+    st.title("👨‍🍳 Cocina")
+    stations = [KITCHEN_DEFAULT_STATION, *dict.fromkeys(KITCHEN_STATIONS.values())]
+    station = st.radio("Estación", stations, horizontal=True, key="kds_station", label_visibility="collapsed")
+    kitchen_view(station)
 
 
 # ============================================================
@@ -1381,23 +3816,13 @@ elif menu_nav == "💵 Caja":
             if not cash_user.strip():
                 st.warning("Ingresa el nombre del cajero.")
             else:
-                db.collection("cajas").add({
-                    "monto_inicial": initial_fund,
-                    "usuario": cash_user.strip(),
-                    "estado": "ABIERTA",
-                    "fecha": now_iso(),
-                    "created_at": now_iso(),
-                })
+                open_cashbox(initial_fund, cash_user.strip())
                 st.success("Caja abierta correctamente.")
                 st.rerun()
     else:
-        sales_docs = list(db.collection("ventas").where("caja_id", "==", cashbox["id"]).stream())
-        expenses_docs = list(db.collection("egresos").where("caja_id", "==", cashbox["id"]).stream())
-        sales = [x.to_dict() for x in sales_docs]
-        expenses = [x.to_dict() for x in expenses_docs]
-
-        total_sales = sum(float(x.get("total", 0)) for x in sales)
-        total_expenses = sum(float(x.get("monto", 0)) for x in expenses)
+        cashbox = ensure_cashbox_aggregates(cashbox)
+        total_sales = float(cashbox.get("ventas_total", 0))
+        total_expenses = float(cashbox.get("egresos_total", 0))
         expected_cash = float(cashbox.get("monto_inicial", 0)) + total_sales - total_expenses
 
         c1, c2, c3, c4 = st.columns(4)
@@ -1406,6 +3831,12 @@ elif menu_nav == "💵 Caja":
         c3.metric("Egresos", f"-{money(total_expenses)}")
         c4.metric("Efectivo esperado", money(expected_cash))
 
+        by_method = cashbox.get("ventas_por_metodo") or {}
+        st.caption(
+            " · ".join([f"{m}: {money(v)}" for m, v in sorted(by_method.items())]
+                       + [f"{int(cashbox.get('ventas_tickets', 0))} tickets"])
+        )
+
         st.divider()
 
         with st.expander("💸 Registrar gasto"):
@@ -1416,41 +3847,46 @@ elif menu_nav == "💵 Caja":
                 if not expense_reason.strip() or expense_amount <= 0:
                     st.warning("Completa motivo y monto mayor a 0.")
                 else:
-                    db.collection("egresos").add({
-                        "caja_id": cashbox["id"],
-                        "motivo": expense_reason.strip(),
-                        "monto": expense_amount,
-                        "fecha": now_iso(),
-                    })
+                    add_expense(cashbox["id"], expense_reason.strip(), expense_amount)
                     st.success("Gasto registrado.")
                     st.rerun()
 
-        with st.expander("🧾 Movimientos del turno", expanded=True):
-            if sales:
-                df_sales = pd.DataFrame(sales)
-                show = [c for c in ["fecha", "folio", "mesa", "total", "metodo", "nota"] if c in df_sales.columns]
+        # Los movimientos solo se descargan cuando se piden.
+        if st.toggle("🧾 Movimientos del turno"):
+            replica = sales_replica()
+            try:
+                replica.sync()
+            except Exception as e:
+                st.caption(f"⚠️ Sin conexión con Firestore, se muestra la copia local: {e}")
+            df_sales = replica.query_df(
+                "SELECT fecha, folio, mesa, total, metodo, nota FROM ventas WHERE caja_id = ? ORDER BY fecha DESC",
+                [cashbox["id"]],
+            )
+            df_exp = replica.query_df(
+                "SELECT fecha, motivo, monto FROM egresos WHERE caja_id = ? ORDER BY fecha DESC",
+                [cashbox["id"]],
+            )
+            if not df_sales.empty:
                 st.markdown("**Ventas**")
-                st.dataframe(df_sales[show], use_container_width=True, hide_index=True)
+                st.dataframe(df_sales, use_container_width=True, hide_index=True)
             else:
                 st.info("Sin ventas en este turno.")
-            if expenses:
-                df_exp = pd.DataFrame(expenses)
-                show = [c for c in ["fecha", "motivo", "monto"] if c in df_exp.columns]
+            if not df_exp.empty:
                 st.markdown("**Egresos**")
-                st.dataframe(df_exp[show], use_container_width=True, hide_index=True)
+                st.dataframe(df_exp, use_container_width=True, hide_index=True)
 
         counted_cash = st.number_input("Efectivo contado al cierre", min_value=0.0, step=10.0)
         diff = counted_cash - expected_cash
         st.caption(f"Diferencia: {money(diff)}")
 
         if st.button("🔒 CERRAR TURNO", type="primary"):
-            db.collection("cajas").document(cashbox["id"]).update({
+            db.collection("cajas").document(cashbox["id"]).update(stamped({
                 "estado": "CERRADA",
                 "cierre": now_iso(),
                 "efectivo_esperado": expected_cash,
                 "efectivo_contado": counted_cash,
                 "diferencia": diff,
-            })
+            }))
             close_ticket_session()
             st.success("Turno cerrado correctamente.")
             st.rerun()
@@ -1477,9 +3913,8 @@ elif menu_nav == "🛒 Catálogo":
     if sel_cat == "➕ Nueva categoría":
         new_cat_name = cc2.text_input("Nombre de nueva categoría")
         if st.button("Crear categoría") and new_cat_name.strip():
-            catalog[new_cat_name.strip()] = {}
-            save_catalog_to_db(catalog)
-            get_catalog.clear()
+            add_catalog_category(new_cat_name.strip())
+            clear_catalog_caches()
             st.success(f"Categoría '{new_cat_name.strip()}' creada.")
             st.rerun()
         st.stop()
@@ -1491,9 +3926,8 @@ elif menu_nav == "🛒 Catálogo":
     if sel_sec == "➕ Nueva sección":
         new_sec_name = cc2.text_input("Nombre de nueva sección")
         if st.button("Crear sección") and new_sec_name.strip():
-            catalog[sel_cat][new_sec_name.strip()] = []
-            save_catalog_to_db(catalog)
-            get_catalog.clear()
+            add_catalog_section(sel_cat, new_sec_name.strip())
+            clear_catalog_caches()
             st.success(f"Sección '{new_sec_name.strip()}' creada.")
             st.rerun()
         st.stop()
@@ -1554,7 +3988,10 @@ elif menu_nav == "🛒 Catálogo":
                 new_ex_price = st.number_input("+ Nuevo adicional (precio $)", step=1.0, key=f"nep_{idx}")
 
                 sf1, sf2 = st.columns(2)
-                if sf1.form_submit_button("💾 Guardar cambios", type="primary"):
+                save_clicked = sf1.form_submit_button("💾 Guardar cambios", type="primary")
+                if save_clicked and duplicate_product_name(products, pname, prod.get("id")):
+                    st.error(f"Ya hay un producto '{pname.strip()}' en {sel_sec}.")
+                elif save_clicked:
                     if new_var_lbl.strip():
                         new_variants.append({"label": new_var_lbl.strip(), "extra": new_var_ext})
                     if new_ex_lbl.strip():
@@ -1568,17 +4005,17 @@ elif menu_nav == "🛒 Catálogo":
                         "flavors": parsed_flavors,
                         "extras": new_extras,
                         "active": True,
+                        "orden": prod.get("orden", idx),
+                        "id": prod.get("id"),
                     }
-                    catalog[sel_cat][sel_sec][idx] = updated
-                    save_catalog_to_db(catalog)
-                    get_catalog.clear()
+                    save_catalog_product(sel_cat, sel_sec, updated)
+                    clear_catalog_caches()
                     st.success("Producto actualizado.")
                     st.rerun()
 
                 if sf2.form_submit_button("🗑️ Eliminar producto"):
-                    catalog[sel_cat][sel_sec].pop(idx)
-                    save_catalog_to_db(catalog)
-                    get_catalog.clear()
+                    delete_catalog_product(prod["id"])
+                    clear_catalog_caches()
                     st.warning("Producto eliminado.")
                     st.rerun()
 
@@ -1604,6 +4041,8 @@ elif menu_nav == "🛒 Catálogo":
         if st.form_submit_button("➕ Agregar producto", type="primary"):
             if not np_name.strip():
                 st.warning("El nombre es obligatorio.")
+            elif duplicate_product_name(products, np_name):
+                st.warning(f"Ya hay un producto '{np_name.strip()}' en {sel_sec}.")
             else:
                 parsed_variants = []
                 for part in np_variants_raw.split(","):
@@ -1641,10 +4080,10 @@ elif menu_nav == "🛒 Catálogo":
                     "flavors": parsed_flavors,
                     "extras": parsed_extras,
                     "active": True,
+                    "orden": max([p.get("orden", 0) for p in products], default=-1) + 1,
                 }
-                catalog[sel_cat][sel_sec].append(new_prod)
-                save_catalog_to_db(catalog)
-                get_catalog.clear()
+                save_catalog_product(sel_cat, sel_sec, new_prod)
+                clear_catalog_caches()
                 st.success(f"Producto '{np_name.strip()}' agregado correctamente.")
                 st.rerun()
 
@@ -1658,15 +4097,51 @@ elif menu_nav == "🛒 Catálogo":
             mime="application/json",
         )
         uploaded_json = st.file_uploader("Subir catálogo JSON", type=["json"])
-        if uploaded_json and st.button("Importar catálogo"):
+        if uploaded_json and st.button("Revisar importación"):
+            st.session_state.catalog_import = None
             try:
                 new_cat = json.loads(uploaded_json.read().decode("utf-8"))
-                save_catalog_to_db(new_cat)
-                get_catalog.clear()
-                st.success("Catálogo importado correctamente.")
+            except ValueError as e:
+                st.error(f"El archivo no es un JSON válido: {e}")
+                new_cat = None
+            if new_cat is not None:
+                errors = validate_catalog(new_cat)
+                if errors:
+                    st.error(f"El catálogo tiene {len(errors)} error(es):")
+                    st.markdown("\n".join(f"- {e}" for e in errors[:20]))
+                else:
+                    st.session_state.catalog_import = diff_catalog(catalog, new_cat)
+
+        plan = st.session_state.catalog_import
+        if plan:
+            st.markdown(
+                f"**Cambios a aplicar:** ➕ {len(plan['added'])} nuevos · "
+                f"✏️ {len(plan['changed'])} modificados · 🗑️ {len(plan['removed'])} eliminados"
+            )
+            preview = (
+                [{"acción": "➕ Nuevo", **plan["rows"][pid]} for pid in plan["added"]]
+                + [{"acción": "✏️ Modificado", **plan["rows"][pid]} for pid in plan["changed"]]
+                + [{"acción": "🗑️ Eliminado", **plan["old_rows"][pid]} for pid in plan["removed"]]
+            )
+            if preview:
+                df_preview = pd.DataFrame(preview)
+                st.dataframe(df_preview[["acción", "categoria", "seccion", "name", "base"]],
+                             use_container_width=True, hide_index=True)
+
+            ic1, ic2 = st.columns(2)
+            if ic1.button("✅ Aplicar importación", type="primary"):
+                current_version = get_catalog_version()
+                if isinstance(current_version, int) and plan["version"] != current_version:
+                    st.warning("El catálogo cambió desde la revisión; vuelve a revisar el archivo.")
+                else:
+                    n_writes = apply_catalog_import(plan)
+                    clear_catalog_caches()
+                    st.session_state.catalog_import = None
+                    st.success(f"Catálogo importado ({n_writes} productos escritos).")
+                    st.rerun()
+            if ic2.button("Descartar"):
+                st.session_state.catalog_import = None
                 st.rerun()
-            except Exception as e:
-                st.error(f"Error al importar: {e}")
 
 
 # ============================================================
@@ -1679,38 +4154,34 @@ elif menu_nav == "📊 Reporte":
         st.warning("🔒 Ingresa el PIN de admin para ver reportes.")
         st.stop()
 
-    sales_docs = list(db.collection("ventas").order_by("fecha", direction=firestore.Query.DESCENDING).limit(500).stream())
-    rows = [x.to_dict() for x in sales_docs]
+    replica = sales_replica()
+    try:
+        replica.sync(force=st.button("🔄 Actualizar"))
+    except Exception as e:
+        st.caption(f"⚠️ Sin conexión con Firestore, se muestra la copia local: {e}")
 
-    if not rows:
-        st.info("No hay ventas registradas aún.")
+    today = now_cdmx().date()
+    f1, f2, f3 = st.columns(3)
+    date_range = f1.date_input("Rango de fechas", value=(today - timedelta(days=6), today), max_value=today)
+    if len(date_range) != 2:
         st.stop()
+    start_day, end_day = date_range
 
-    df = pd.DataFrame(rows)
-    if "fecha" in df.columns:
-        df["fecha_dt"] = pd.to_datetime(df["fecha"], errors="coerce")
-        df["dia"] = df["fecha_dt"].dt.date.astype(str)
-    else:
-        df["dia"] = "Sin fecha"
+    range_where, range_params = replica_filters(start_day, end_day)
+    options = replica.query_df(f"SELECT DISTINCT metodo, mesa FROM ventas WHERE {range_where}", range_params)
+    if options.empty:
+        st.info("No hay ventas en el rango seleccionado.")
+        st.stop()
 
-    methods = sorted(df["metodo"].dropna().unique().tolist()) if "metodo" in df.columns else []
-    spaces = sorted(df["mesa"].dropna().unique().tolist()) if "mesa" in df.columns else []
+    methods = sorted(options["metodo"].dropna().unique().tolist())
+    spaces = sorted(options["mesa"].dropna().unique().tolist())
+    method_filter = f2.multiselect("Método de pago", methods, default=methods)
+    space_filter = f3.multiselect("Mesa / espacio", spaces, default=spaces)
+    where, params = replica_filters(start_day, end_day, method_filter, space_filter)
 
-    f1, f2, f3 = st.columns(3)
-    method_filter = f1.multiselect("Método de pago", methods, default=methods)
-    space_filter = f2.multiselect("Mesa / espacio", spaces, default=spaces)
-    day_filter = f3.selectbox("Día", ["Todos"] + sorted(df["dia"].dropna().unique().tolist(), reverse=True))
-
-    filtered = df.copy()
-    if method_filter:
-        filtered = filtered[filtered["metodo"].isin(method_filter)]
-    if space_filter:
-        filtered = filtered[filtered["mesa"].isin(space_filter)]
-    if day_filter != "Todos":
-        filtered = filtered[filtered["dia"] == day_filter]
-
-    total_sales = float(filtered["total"].sum()) if "total" in filtered.columns else 0
-    total_tickets = len(filtered)
+    totals = replica.query_df(f"SELECT COALESCE(SUM(total), 0) AS total, COUNT(*) AS tickets FROM ventas WHERE {where}", params)
+    total_sales = float(totals["total"].iloc[0])
+    total_tickets = int(totals["tickets"].iloc[0])
     avg_ticket = total_sales / total_tickets if total_tickets else 0
 
     k1, k2, k3 = st.columns(3)
@@ -1720,22 +4191,102 @@ elif menu_nav == "📊 Reporte":
 
     st.divider()
 
-    if "metodo" in filtered.columns:
-        pay_summary = filtered.groupby("metodo", as_index=False)["total"].sum().sort_values("total", ascending=False)
-        st.markdown("**Por método de pago**")
-        st.dataframe(pay_summary, use_container_width=True, hide_index=True)
-
-    if "mesa" in filtered.columns:
-        space_summary = filtered.groupby("mesa", as_index=False)["total"].sum().sort_values("total", ascending=False)
-        st.markdown("**Por mesa / espacio**")
-        st.dataframe(space_summary, use_container_width=True, hide_index=True)
-
-    show_cols = [c for c in ["fecha", "folio", "mesa", "total", "metodo", "nota"] if c in filtered.columns]
+    pay_summary = replica.query_df(
+        f"SELECT metodo, SUM(total) AS total, COUNT(*) AS tickets FROM ventas WHERE {where} GROUP BY metodo ORDER BY total DESC",
+        params,
+    )
+    st.markdown("**Por método de pago**")
+    st.dataframe(pay_summary, use_container_width=True, hide_index=True)
+
+    space_summary = replica.query_df(
+        f"SELECT mesa, SUM(total) AS total, COUNT(*) AS tickets FROM ventas WHERE {where} GROUP BY mesa ORDER BY total DESC",
+        params,
+    )
+    st.markdown("**Por mesa / espacio**")
+    st.dataframe(space_summary, use_container_width=True, hide_index=True)
+
+    lines = load_sale_lines(where, tuple(params), replica.last_sync, get_catalog_version())
+    if not lines.empty:
+        analytics = product_analytics(lines)
+        st.markdown("**Productos más vendidos**")
+        st.dataframe(analytics["top"].head(20), use_container_width=True, hide_index=True)
+        st.markdown("**Ventas por categoría**")
+        st.dataframe(analytics["categories"], use_container_width=True, hide_index=True)
+        if not analytics["extras"].empty:
+            st.markdown("**Adicionales** *(sobre unidades de productos que los ofrecen)*")
+            st.dataframe(analytics["extras"], use_container_width=True, hide_index=True)
+
+    st.markdown("**Afluencia por hora y día de la semana** *(todos los métodos y espacios)*")
+    heat_metric = st.radio("Medir", ["tickets", "total"], horizontal=True, key="heat_metric",
+                           format_func=lambda m: "Tickets" if m == "tickets" else "Ventas $")
+    heat = hourly_heatmap(load_daily_rollups(start_day, end_day), heat_metric)
+    if heat.empty:
+        st.caption("Sin resúmenes para el rango; reconstrúyelos desde ⚙️ Config.")
+    else:
+        st.vega_lite_chart(heat, {
+            "mark": "rect",
+            "encoding": {
+                "x": {"field": "hora", "type": "ordinal", "title": "Hora"},
+                "y": {"field": "dia", "type": "ordinal", "title": None, "sort": WEEKDAYS},
+                "color": {"field": heat_metric, "type": "quantitative", "title": None},
+                "tooltip": [{"field": "dia"}, {"field": "hora"}, {"field": heat_metric}],
+            },
+        }, use_container_width=True)
+
+    # Paginación por llave (fecha, id): cada página arranca después de la
+    # última fila de la anterior, sin OFFSET que recorra lo ya mostrado.
+    query_key = (where, tuple(params))
+    pages = st.session_state.report_pages
+    if not pages or pages["key"] != query_key:
+        pages = {"key": query_key, "cursors": [None]}
+        st.session_state.report_pages = pages
+    n_pages = max(1, -(-total_tickets // SALES_PAGE_SIZE))
+    page = len(pages["cursors"]) - 1
+
+    page_where, page_params = f"({where})", list(params)
+    cursor = pages["cursors"][-1]
+    if cursor:
+        page_where += " AND (fecha < ? OR (fecha = ? AND id < ?))"
+        page_params += [cursor[0], cursor[0], cursor[1]]
+    detail = replica.query_df(
+        f"SELECT id, fecha, folio, mesa, total, metodo, nota FROM ventas WHERE {page_where}"
+        " ORDER BY fecha DESC, id DESC LIMIT ?",
+        page_params + [SALES_PAGE_SIZE],
+    )
     st.markdown("**Detalle de ventas**")
-    st.dataframe(filtered[show_cols], use_container_width=True, hide_index=True)
+    st.dataframe(detail.drop(columns=["id"]), use_container_width=True, hide_index=True)
 
-    csv = filtered.to_csv(index=False).encode("utf-8-sig")
-    st.download_button("⬇️ Descargar CSV", data=csv, file_name=f"kin_report_{now_cdmx().strftime('%Y%m%d_%H%M%S')}.csv", mime="text/csv")
+    n1, n2, n3 = st.columns([1, 2, 1])
+    if n1.button("◀ Anterior", disabled=page == 0):
+        pages["cursors"].pop()
+        st.rerun()
+    n2.caption(f"Página {page + 1} de {n_pages}")
+    if n3.button("Siguiente ▶", disabled=page >= n_pages - 1 or len(detail) < SALES_PAGE_SIZE):
+        last = detail.iloc[-1]
+        pages["cursors"].append((last["fecha"], last["id"]))
+        st.rerun()
+
+    st.divider()
+    st.markdown("**Exportar ventas del rango** *(una fila por producto)*")
+    e1, e2 = st.columns([1, 2])
+    export_fmt = e1.selectbox("Formato", ["CSV"] + (["Parquet"] if pq else []))
+    if e2.button("📦 Preparar archivo"):
+        with st.spinner("Exportando ventas..."):
+            fmt = export_fmt.lower()
+            path = export_sales(replica.iter_sales(where, params), fmt)
+        previous = st.session_state.export_file
+        if previous and os.path.exists(previous["path"]):
+            os.remove(previous["path"])
+        st.session_state.export_file = {
+            "path": path,
+            "name": f"kin_ventas_{start_day:%Y%m%d}_{end_day:%Y%m%d}.{fmt}",
+            "mime": "text/csv" if fmt == "csv" else "application/octet-stream",
+        }
+
+    export_file = st.session_state.export_file
+    if export_file and os.path.exists(export_file["path"]):
+        with open(export_file["path"], "rb") as fh:
+            st.download_button(f"⬇️ Descargar {export_file['name']}", data=fh, file_name=export_file["name"], mime=export_file["mime"])
 
 
 # ============================================================
@@ -1758,7 +4309,7 @@ elif menu_nav == "⚙️ Config":
             st.markdown(
                 f"""
                 <div style="background:var(--espresso);border-radius:16px;padding:20px;text-align:center;">
-                    <img src="{brand['logo_url']}"
+                    <img src="{logo_src(brand, SIDEBAR_LOGO_PX)}"
                          style="max-width:140px;max-height:140px;border-radius:10px;object-fit:contain;">
                     <div style="color:rgba(250,247,242,0.6);font-size:11px;margin-top:8px;">Logo actual</div>
                 </div>
@@ -1801,19 +4352,13 @@ elif menu_nav == "⚙️ Config":
 
             if st.button("✅ Guardar este logo", type="primary"):
                 logo_url = upload_logo_to_storage(raw, logo_file.name)
-                db.collection("config").document("branding").set(
-                    {"logo_url": logo_url},
-                    merge=True
-                )
+                save_brand({"logo_url": logo_url, "logos": brand_logos(raw)})
                 st.success("Logo guardado correctamente.")
                 st.rerun()
 
         if brand.get("logo_url"):
             if st.button("🗑️ Eliminar logo actual"):
-                db.collection("config").document("branding").set(
-                    {"logo_url": ""},
-                    merge=True
-                )
+                save_brand({"logo_url": "", "logos": firestore.DELETE_FIELD})
                 st.warning("Logo eliminado.")
                 st.rerun()
 
@@ -1826,24 +4371,86 @@ elif menu_nav == "⚙️ Config":
         slogan = st.text_input("Slogan", value=brand.get("slogan", "Mismo sabor, mismo lugar"))
 
         if st.form_submit_button("Guardar nombre y slogan", type="primary"):
-            db.collection("config").document("branding").set(
-                {
-                    "nombre": brand_name.strip(),
-                    "slogan": slogan.strip()
-                },
-                merge=True
-            )
+            save_brand({
+                "nombre": brand_name.strip(),
+                "slogan": slogan.strip()
+            })
             st.success("Guardado correctamente.")
             st.rerun()
 
     st.divider()
 
+    # ---- RESÚMENES DIARIOS ----
+    st.markdown("### 📈 Resúmenes diarios de ventas")
+    st.caption("Recalcula los resúmenes del reporte a partir de las ventas registradas en el rango.")
+    today = now_cdmx().date()
+    rebuild_range = st.date_input("Rango a reconstruir", value=(today - timedelta(days=30), today), max_value=today)
+    if st.button("🔁 Reconstruir resúmenes") and len(rebuild_range) == 2:
+        with st.spinner("Reconstruyendo..."):
+            n_days = rebuild_daily_rollups(*rebuild_range)
+        st.success(f"Resúmenes reconstruidos: {n_days} días con ventas.")
+
+    st.divider()
+
+    # ---- ESPACIOS ----
+    st.markdown("### 🪑 Espacios")
+    st.caption("Mesas y canales de venta agrupados por zona. Marca «cola» en barra y para llevar para abrir varios pedidos numerados. Desactiva en lugar de borrar los espacios con historial.")
+    spaces_df = pd.DataFrame(get_spaces(include_inactive=True), columns=["id", "nombre", "zona", "orden", "activo", "cola"])
+    edited_spaces = st.data_editor(
+        spaces_df, num_rows="dynamic", hide_index=True, use_container_width=True,
+        column_config={"id": None}, key="spaces_editor",
+    )
+    if st.button("💾 Guardar espacios"):
+        space_rows = [{k: (None if pd.isna(v) else v) for k, v in r.items()} for r in edited_spaces.to_dict("records")]
+        space_rows = [r for r in space_rows if str(r.get("nombre") or "").strip()]
+        space_names = [str(r["nombre"]).strip() for r in space_rows]
+        space_errors = [] if len(set(space_names)) == len(space_names) else ["Hay espacios con el mismo nombre."]
+        space_errors += validate_space_changes(space_rows)
+        if space_errors:
+            st.error("\n".join(f"- {e}" for e in space_errors))
+        else:
+            save_spaces(space_rows)
+            st.success("Espacios guardados.")
+            st.rerun()
+
+    st.divider()
+
+    # ---- LÍNEAS ESTRUCTURADAS ----
+    st.markdown("### 🧩 Migrar líneas de venta")
+    st.caption("Convierte las líneas antiguas (solo nombre) de comandas y ventas al formato con id de producto.")
+    if st.button("🧩 Migrar líneas"):
+        with st.spinner("Migrando..."):
+            migrated = migrate_line_items()
+        st.success(f"Comandas actualizadas: {migrated['comandas']} · Ventas actualizadas: {migrated['ventas']}")
+
+    st.divider()
+
+    # ---- SINCRONIZACIÓN ----
+    st.markdown("### 🔄 Sincronización")
+    st.caption("Cambios guardados en esta terminal que Firestore rechazó (p. ej. una comanda cerrada en otra tableta) "
+               "o que fallaron varias veces. Los cobros no se pueden descartar: se reintentan hasta registrarse.")
+    sync_conflicts = sync_journal().conflicts()
+    if not sync_conflicts:
+        st.info("Sin conflictos pendientes.")
+    else:
+        st.dataframe(pd.DataFrame(sync_conflicts).drop(columns=["op_id"]), use_container_width=True, hide_index=True)
+        sc1, sc2 = st.columns(2)
+        if sc1.button("🔁 Reintentar"):
+            sync_journal().requeue([c["op_id"] for c in sync_conflicts])
+            sync_worker().wake()
+            st.rerun()
+        if sc2.button("🧹 Descartar conflictos"):
+            sync_journal().discard([c["op_id"] for c in sync_conflicts])
+            st.rerun()
+
+    st.divider()
+
     # ---- RESTAURAR CATÁLOGO ----
     st.markdown("### 🗄️ Catálogo base")
     st.caption("Restaura todos los productos del menú oficial de KIN House. Sobreescribirá el catálogo actual.")
 
     if st.button("🔄 Restaurar catálogo base", type="primary"):
-        save_catalog_to_db(DEFAULT_CATALOG)
-        get_catalog.clear()
+        write_catalog_tree(DEFAULT_CATALOG)
+        clear_catalog_caches()
         st.success("Catálogo restaurado correctamente.")
         st.rerun()